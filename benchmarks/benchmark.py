@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+'''
+benchmark.py
+
+@summary: Benchmarks for building and writing KML documents with kml_writer.
+
+Every scenario builds a KMLDocument from synthetic data and writes it with writeKML. Wall time, peak RSS and output
+size are reported separately for each phase. The peak RSS of a process never goes down, so every phase reports the
+peak of the process so far (cumulativePeakRSS) and how much the phase raised it (peakRSSGrowth):
+
+build - creating element objects
+insert - adding elements to the document and its folders
+write - serializing the document to a file
+
+Each scenario runs in a separate process, so peak RSS of one scenario doesn't affect the others.
+
+Parallel writing is measured by running the scenarios with and without --processes on a machine with several CPUs
+and comparing the two result files. writeKML limits the processes to the number of CPUs and writes small documents
+serially, so on a single CPU both runs take the same path.
+
+Memory use of element objects is measured separately with --memory, which reports bytes per Point.
+
+Usage:
+python benchmarks/benchmark.py --scales 1000 100000 --output results.json
+python benchmarks/benchmark.py --compare old.json results.json
+python benchmarks/benchmark.py --scales 100000 1000000 --processes 4 --output parallel.json
+python benchmarks/benchmark.py --compare results.json parallel.json
+python benchmarks/benchmark.py --memory 1000000
+
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import kml_writer as kml
+
+
+def peakRSS():
+    """ Return peak resident set size of the process in kilobytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on macOS
+        rss //= 1024
+    return rss
+
+def phaseResult(start, rssBefore, **kwargs):
+    """ Return results of a phase that started at start, when the peak RSS was rssBefore """
+    rss = peakRSS()
+    kwargs.update({'seconds': time.time() - start, 'cumulativePeakRSS': rss, 'peakRSSGrowth': rss - rssBefore})
+    return kwargs
+
+def coordinates(n, seed=0):
+    """ Return lists of n random latitudes and longitudes around Krakow """
+    rnd = random.Random(seed)
+    lats = [50.0 + rnd.random() for i in xrange(n)]
+    lons = [19.5 + rnd.random() for i in xrange(n)]
+    return lats, lons
+
+
+def buildPoints(n):
+    """ Points with timestamps in a single folder """
+    lats, lons = coordinates(n)
+    elements = [kml.Point(lat, lon, name="p%d" % i, datetime="2011-11-03T12:00:%02dZ" % (i % 60), style="pointStyle")
+                for i, (lat, lon) in enumerate(zip(lats, lons))]
+    return [kml.Style("pointStyle", icon={'icon': 'http://maps.google.com/mapfiles/kml/paddle/wht-blank.png'})], [("Points", elements)]
+
+def buildPath(n):
+    """ A single path with n vertices """
+    lats, lons = coordinates(n)
+    alts = [i % 1000 for i in xrange(n)]
+    return [kml.Path(lats, lons, altsArray=alts, tessellate=1, name="Track", style="trackStyle"),
+            kml.Style("trackStyle", line={'color': 'ff00ff00', 'width': '4'})], []
+
+def buildTrack(n):
+    """ A single gx:Track with n timestamped samples, the same data as the points scenario """
+    lats, lons = coordinates(n)
+    whens = ["2011-11-03T12:00:%02dZ" % (i % 60) for i in xrange(n)]
+    return [kml.Track(whens, lats, lons, name="Track", style="trackStyle"),
+            kml.Style("trackStyle", line={'color': 'ff00ff00', 'width': '4'})], []
+
+def buildPolygon(n):
+    """ A single polygon with n vertices """
+    lats, lons = coordinates(n)
+    lats.append(lats[0])
+    lons.append(lons[0])
+    return [kml.Polygon("Area", "", latsArray=lats, lonsArray=lons, style="polyStyle"),
+            kml.Style("polyStyle", line={'color': 'ff0000ff'}, poly={'color': '7f0000ff'})], []
+
+def buildStyled(n, categories=10):
+    """ Points spread over styled folders with a StyleMap for every category """
+    lats, lons = coordinates(n)
+    elements = []
+    folders = [("Category %d" % c, []) for c in xrange(categories)]
+    for c in xrange(categories):
+        elements.append(kml.Style("normal%d" % c, icon={'scale': '1.0'}))
+        elements.append(kml.Style("highlight%d" % c, icon={'scale': '1.4'}))
+        elements.append(kml.StyleMap("category%d" % c, {'normal': '#normal%d' % c, 'highlight': '#highlight%d' % c}))
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        c = i % categories
+        folders[c][1].append(kml.Point(lat, lon, name="p%d" % i, description="<b>Point %d</b>" % i, style="category%d" % c))
+    return elements, folders
+
+scenarios = {
+    'points': buildPoints,
+    'path': buildPath,
+    'polygon': buildPolygon,
+    'styled': buildStyled,
+    'track': buildTrack,
+}
+
+
+def runScenario(args):
+    """ Run a single scenario and return its results. Called in a separate process. """
+    name, scale, processes = args
+    results = {'scenario': name, 'scale': scale, 'processes': processes}
+
+    start, rss = time.time(), peakRSS()
+    elements, folders = scenarios[name](scale)
+    results['build'] = phaseResult(start, rss)
+
+    start, rss = time.time(), peakRSS()
+    kmldoc = kml.KMLDocument("Benchmark %s %d" % (name, scale))
+    kmldoc.addElements(*elements)
+    for folderName, folderElements in folders:
+        kmldoc.addFolder(kml.Folder(folderName))
+        for element in folderElements:
+            kmldoc.addElementToFolder(element, folderName)
+    results['insert'] = phaseResult(start, rss)
+
+    fd, filename = tempfile.mkstemp(suffix=".kml")
+    os.close(fd)
+    try:
+        start, rss = time.time(), peakRSS()
+        kml.writeKML(kmldoc.document, filename, processes=processes)
+        results['write'] = phaseResult(start, rss, bytes=os.path.getsize(filename))
+    finally:
+        os.remove(filename)
+    return results
+
+def run(names, scales, processes=None):
+    """ Run scenarios at all scales, writing with the given number of worker processes. Return a list of results. """
+    results = []
+    for scale in scales:
+        for name in names:
+            # A new process for every run, so peak RSS is measured for a single scenario
+            pool = multiprocessing.Pool(1)
+            try:
+                result = pool.apply(runScenario, [(name, scale, processes)])
+            finally:
+                pool.terminate()
+            printResult(result)
+            results.append(result)
+    return results
+
+def measurePointMemory(n):
+    """ Return bytes per Point measured from RSS growth and from sys.getsizeof. Called in a separate process. """
+    lats, lons = coordinates(n)
+    names = ["p%d" % i for i in xrange(n)]
+    before = peakRSS()
+    points = [kml.Point(lat, lon, name=name, style="pointStyle") for lat, lon, name in zip(lats, lons, names)]
+    after = peakRSS()
+    point = points[0]
+    size = sys.getsizeof(point)
+    if hasattr(point, '__dict__'):
+        size += sys.getsizeof(point.__dict__)
+    return {'points': n, 'rssBytesPerPoint': (after - before) * 1024.0 / n, 'instanceBytes': size}
+
+def memory(n):
+    """ Print memory used per Point """
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.apply(measurePointMemory, [n])
+    finally:
+        pool.terminate()
+    print "Point: %.1f bytes per point (RSS), %d bytes per instance (getsizeof)" % (result['rssBytesPerPoint'], result['instanceBytes'])
+    return result
+
+def printResult(result):
+    """ Print a single scenario result, with the peak RSS so far and its growth in every phase """
+    phases = ["%s %.3fs %dMB (+%dMB)" % (phase, result[phase]['seconds'], result[phase]['cumulativePeakRSS'] // 1024,
+                                        result[phase]['peakRSSGrowth'] // 1024)
+              for phase in ('build', 'insert', 'write')]
+    print "%-8s %9d  %s  %d bytes" % (result['scenario'], result['scale'], "  ".join(phases), result['write']['bytes'])
+
+def compare(oldFilename, newFilename):
+    """ Print time ratios of matching scenarios in two result files """
+    with open(oldFilename) as f:
+        old = dict(((r['scenario'], r['scale']), r) for r in json.load(f)['results'])
+    with open(newFilename) as f:
+        new = json.load(f)['results']
+    for result in new:
+        key = (result['scenario'], result['scale'])
+        if key not in old:
+            continue
+        ratios = ["%s x%.2f" % (phase, old[key][phase]['seconds'] / max(result[phase]['seconds'], 1e-9))
+                  for phase in ('build', 'insert', 'write')]
+        print "%-8s %9d  %s  (speedup, old/new)" % (key[0], key[1], "  ".join(ratios))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark building and writing KML documents")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 100000, 1000000], help="numbers of elements or vertices")
+    parser.add_argument('--scenarios', nargs='+', default=sorted(scenarios), choices=sorted(scenarios))
+    parser.add_argument('--output', default="benchmark_results.json", help="JSON file to save results to")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two saved result files")
+    parser.add_argument('--memory', type=int, metavar='N', help="measure memory used by N Point objects")
+    parser.add_argument('--processes', type=int, help="number of worker processes writing the documents")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.memory:
+        memory(args.memory)
+    else:
+        results = run(args.scenarios, args.scales, args.processes)
+        with open(args.output, "w") as f:
+            json.dump({
+                'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': multiprocessing.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+        print "Results saved to %s" % args.output
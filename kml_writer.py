@@ -38,186 +38,3305 @@ See Google's KML documentation for more information.
 
 '''
 
+import os
+import re
+import sys
+import math
+import time
+import heapq
+import array
+import zlib
+import shutil
+import zipfile
 import csv
+import codecs
+import datetime
+import itertools
+import contextlib
+import collections
+import multiprocessing
+import StringIO
+import cStringIO
+import cPickle
+import tempfile
 import xml.dom.minidom as xdm
+import xml.etree.cElementTree as ElementTree
+import dateutil.tz
 import dateutil.parser as dtparser
 
+try:
+    import numpy
+except ImportError:
+    # Only needed for simplification of paths and polygons
+    numpy = None
+
+
+# Indentation used for every level of pretty printed output
+INDENT = "   "
+
+# Namespace of Google extensions to KML, used by gx: elements
+GX_NAMESPACE = "http://www.google.com/kml/ext/2.2"
+
 
 class Element(xdm.Element):
     """ A class to make KML output compatible with Google Earth """
     
-    def writexml(self, writer, indent="", addindent="", newl=""):
-        """ Write XML to the writer object """
-        # indent = current indentation
-        # addindent = indetation to add to higher levels
-        # newl = newline string
-        writer.write(indent + "<" + self.tagName)
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        """ Write XML to the writer object """
+        # indent = current indentation
+        # addindent = indetation to add to higher levels
+        # newl = newline string
+        writer.write(indent + "<" + self.tagName)
+        
+        attrs = self._get_attributes()
+        a_names = attrs.keys()
+        a_names.sort()
+        
+        for a_name in a_names:
+            writer.write(" %s=\"" %a_name)
+            xdm._write_data(writer, attrs[a_name].value)
+            writer.write("\"")
+        
+        if self.childNodes:
+            newl2 = newl
+            if len(self.childNodes) == 1 and self.childNodes[0].nodeType == xdm.Node.TEXT_NODE:
+                indent, addindent, newl = "", "", ""            
+            writer.write(">%s" %(newl))
+            
+            for node in self.childNodes:
+                node.writexml(writer, indent+addindent, addindent, newl)                            
+            writer.write("%s</%s>%s" %(indent, self.tagName, newl2))            
+        else:
+            writer.write("/>%s" %(newl))
+
+
+class Document(xdm.Document):
+    """ A DOM document creating Element nodes.
+    
+    Used instead of replacing xml.dom.minidom.Element, which would change the output of all other minidom users.
+    
+    """
+    
+    # KMLStats of the KMLDocument when instrumentation is enabled
+    stats = None
+    
+    def createElement(self, tagName):
+        """ Create an Element node """
+        e = Element(tagName)
+        e.ownerDocument = self
+        return e
+
+
+class Fragment(Element):
+    """ An element node that writes pre-rendered KML instead of its own children.
+    
+    Used by bulk elements such as PointBatch, which render many placemarks with string templates rather than
+    building a DOM node for each of them.
+    
+    """
+    
+    def __init__(self, render):
+        """ Init Fragment
+        
+        Arguments:
+        render - a function taking (writer, indent, addindent, newl) arguments that writes the fragment
+        
+        """
+        Element.__init__(self, '#fragment')
+        self.render = render
+        
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        """ Write XML to the writer object """
+        self.render(writer, indent, addindent, newl)
+
+
+class StyleFragment(Fragment):
+    """ An element node writing a Style or StyleMap from a StyleCache.
+    
+    The DOM node of the style is kept as the only child, so the document can still be searched and modified. Set
+    element to None after modifying the child to write it instead of the cached text. The child is also written if
+    the style object has been changed since it was added, as the rest of the document keeps nodes of that time.
+    
+    """
+    
+    def __init__(self, element, node, cache):
+        """ Init StyleFragment
+        
+        Arguments:
+        element - Style or StyleMap object
+        node - DOM node created by element.kml()
+        cache - StyleCache of the document
+        
+        """
+        Fragment.__init__(self, self.renderStyle)
+        self.element = element
+        self.cache = cache
+        self.key = (element.id, element.key())
+        self.appendChild(node)
+        
+    def renderStyle(self, writer, indent, addindent, newl):
+        """ Write the cached style text, or the child node if the style has changed """
+        if self.element is None or (self.element.id, self.element.key()) != self.key:
+            out = _BufferedWriter(writer)
+            _serializeNode(self.firstChild, out, indent, addindent, newl)
+            out.flush()
+        else:
+            writer.write(self.cache.text(self.element, indent, addindent, newl))
+
+
+class StyleCache:
+    """ StyleCache class.
+    
+    Serialized Style and StyleMap elements by id, content and indentation, least recently used first. Used by
+    KMLDocument and KMLStreamWriter, so styles written again are copied instead of rebuilt. A cache can be shared by
+    writers of files with the same styles, e.g. tiles of writeTiledKML.
+    
+    """
+    
+    def __init__(self, size=1024):
+        """ Init StyleCache
+        
+        Arguments:
+        size - maximum number of serialized styles kept
+        
+        """
+        self.size = size
+        self.texts = collections.OrderedDict()
+        
+    def text(self, element, indent, addindent, newl):
+        """ Return a Style or StyleMap serialized at the given indentation, from the cache if it was written before.
+        
+        The key is made of the current id and content of the style, so a style changed after it was cached is
+        serialized again.
+        
+        """
+        key = (element.__class__, element.id, element.key(), indent, addindent, newl)
+        text = self.texts.pop(key, None)
+        if text is None:
+            buf = StringIO.StringIO()
+            out = _BufferedWriter(buf)
+            _serializeNode(element.kml().documentElement, out, indent, addindent, newl)
+            out.flush()
+            text = buf.getvalue()
+            if len(self.texts) >= self.size:
+                self.texts.popitem(last=False)
+        self.texts[key] = text
+        return text
+
+
+class _BufferedWriter:
+    """ Collects written strings and passes them to the underlying writer joined in large blocks """
+    
+    # Number of strings collected before they are written
+    size = 4096
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.parts = []
+        
+    def write(self, data):
+        self.parts.append(data)
+        if len(self.parts) >= self.size:
+            self.flush()
+            
+    def flush(self):
+        self.writer.write("".join(self.parts))
+        del self.parts[:]
+
+TEXT_NODE = xdm.Node.TEXT_NODE
+
+# Cached opening and closing tags of elements without attributes
+_openTags = {}
+_closeTags = {}
+
+def _serializeNode(node, out, indent, addindent, newl):
+    """ Serialize a node to a _BufferedWriter.
+    
+    Writes the same output as Element.writexml, but with cached tags, a single write call for text elements and
+    without going through writexml for every node. Nodes of other classes are written with their own writexml.
+    
+    """
+    if node.__class__ is not Element:
+        node.writexml(out, indent, addindent, newl)
+        return
+    
+    tag = node.tagName
+    attrs = node._attrs
+    if attrs:
+        openTag = "<%s%s>" % (tag, "".join([' %s="%s"' % (name, _escape(attrs[name].value)) for name in sorted(attrs)]))
+    else:
+        openTag = _openTags.get(tag)
+        if openTag is None:
+            openTag = _openTags[tag] = "<%s>" % tag
+    closeTag = _closeTags.get(tag)
+    if closeTag is None:
+        closeTag = _closeTags[tag] = "</%s>" % tag
+    
+    children = node.childNodes
+    parts = out.parts
+    if not children:
+        parts.append(indent + openTag[:-1] + "/>" + newl)
+    elif len(children) == 1 and children[0].nodeType == TEXT_NODE:
+        data = children[0].data
+        if not newl and tag == 'coordinates':
+            # Tuples are separated by single spaces in compact output, with no spaces inside them
+            data = data.replace(", ", ",").replace("\n", " ")
+        parts.append(indent + openTag + _escape(data) + closeTag + newl)
+    else:
+        parts.append(indent + openTag + newl)
+        childIndent = indent + addindent
+        for child in children:
+            if child.nodeType == TEXT_NODE:
+                parts.append(_escape(childIndent + child.data + newl))
+            else:
+                _serializeNode(child, out, childIndent, addindent, newl)
+        parts.append(indent + closeTag + newl)
+        if len(parts) >= out.size:
+            out.flush()
+
+def _serializeDocument(doc, writer, compact=False):
+    """ Serialize a DOM document to a writer object accepting unicode strings, without whitespace if compact """
+    addindent, newl = _whitespace(compact)
+    out = _BufferedWriter(writer)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>' + newl)
+    for node in doc.childNodes:
+        _serializeNode(node, out, "", addindent, newl)
+    out.flush()
+
+def _whitespace(compact):
+    """ Return indentation and newline strings of pretty printed or compact output """
+    if compact:
+        return "", ""
+    return INDENT, "\n"
+
+
+def parseDate(dateString, dayFirst=True):
+    """ Attempt to parse a date time string and return a string formatted for google earth as 'yyyy-mm-ddThh:mm:ssZ'. 
+    
+    Arguments:
+    dateString - A date and time in an any format as string
+    dayFirst - specifies if in case of ambiguous dates first number should be day or month. 
+    
+    Returns 0 on failure.
+    
+    """
+    try:
+        dt = dtparser.parse(dateString, dayfirst=dayFirst)
+        return dt.isoformat() + "Z"
+    except:        
+        return 0
+
+# Date and time layouts tried by parseDates, in order of preference for dayFirst True and False
+_dateLayouts = {
+    True: ['%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%m-%d-%Y', '%d.%m.%Y', '%m.%d.%Y', '%Y-%d-%m', '%Y-%m-%d', '%Y/%d/%m', '%Y/%m/%d'],
+    False: ['%m/%d/%Y', '%d/%m/%Y', '%m-%d-%Y', '%d-%m-%Y', '%m.%d.%Y', '%d.%m.%Y', '%Y-%m-%d', '%Y-%d-%m', '%Y/%m/%d', '%Y/%d/%m'],
+}
+_timeLayouts = ['', ' %H:%M:%S', ' %H:%M', 'T%H:%M:%S', 'T%H:%M', ' %H:%M:%S.%f', 'T%H:%M:%S.%f']
+_dateFields = {
+    'Y': r'(?P<Y>\d{4})',
+    'm': r'(?P<m>\d{1,2})',
+    'd': r'(?P<d>\d{1,2})',
+    'H': r'(?P<H>\d{1,2})',
+    'M': r'(?P<M>\d{1,2})',
+    'S': r'(?P<S>\d{1,2})',
+    'f': r'(?P<f>\d{1,6})',
+}
+
+def _compileDateFormat(fmt):
+    """ Compile a strptime style format to a regular expression """
+    pattern = []
+    for token in re.split(r'(%\w)', fmt):
+        if token.startswith('%'):
+            pattern.append(_dateFields[token[1]])
+        else:
+            pattern.append(re.escape(token))
+    return re.compile("".join(pattern) + r'\Z')
+
+def _fastParseDate(regex, dateString):
+    """ Parse a date string with a compiled format. Return a parseDate style string or None if it doesn't match. """
+    match = regex.match(dateString)
+    if match is None:
+        return None
+    g = match.groupdict()
+    try:
+        dt = datetime.datetime(int(g['Y']), int(g['m']), int(g['d']), int(g.get('H') or 0), int(g.get('M') or 0),
+                               int(g.get('S') or 0), int((g.get('f') or '0').ljust(6, '0')))
+    except ValueError:
+        return None
+    return dt.isoformat() + "Z"
+
+def _detectDateFormat(samples, dayFirst):
+    """ Find the first format that parses all samples the same way as parseDate.
+    
+    Return a list of compiled regexes for the format and for the same format with day and month swapped, which is
+    how dateutil reads dates that are invalid in the preferred order (e.g. 13 as a month). Return an empty list if
+    there is no matching format.
+    
+    """
+    expected = [(sample, parseDate(sample, dayFirst)) for sample in samples]
+    for layout in _dateLayouts[bool(dayFirst)]:
+        for timeLayout in _timeLayouts:
+            regex = _compileDateFormat(layout + timeLayout)
+            matched = False
+            for sample, parsed in expected:
+                result = _fastParseDate(regex, sample)
+                if result is None:
+                    continue
+                if result != parsed:
+                    break
+                matched = True
+            else:
+                if matched:
+                    swapped = layout.replace('%d', '%_').replace('%m', '%d').replace('%_', '%m')
+                    return [regex, _compileDateFormat(swapped + timeLayout)]
+    return []
+
+def parseDates(dateStrings, dayFirst=True, cacheSize=10000, sampleSize=10):
+    """ Parse many date strings. Return a generator of strings formatted like the ones from parseDate.
+    
+    Arguments:
+    dateStrings - an iterable of date strings, usually a single column from a CSV file
+    dayFirst - specifies if in case of ambiguous dates first number should be day or month
+    cacheSize - number of recently parsed strings to remember
+    sampleSize - number of strings used to detect the format of the column
+    
+    The format is detected once from the first values and later values are parsed with a regular expression, which
+    is much faster than dateutil. Values that don't match the detected format are parsed with parseDate, so results
+    (including 0 on failure) are always the same as the ones from parseDate.
+    
+    """
+    dateStrings = iter(dateStrings)
+    head = []
+    samples = []
+    for dateString in dateStrings:
+        head.append(dateString)
+        if isinstance(dateString, basestring) and dateString.strip():
+            samples.append(dateString)
+            if len(samples) >= sampleSize:
+                break
+    regexes = _detectDateFormat(samples, dayFirst)
+    
+    cache = collections.OrderedDict()
+    for dateString in itertools.chain(head, dateStrings):
+        if not isinstance(dateString, basestring):
+            yield parseDate(dateString, dayFirst)
+            continue
+        result = cache.pop(dateString, None)
+        if result is None:
+            for regex in regexes:
+                result = _fastParseDate(regex, dateString)
+                if result is not None:
+                    break
+            else:
+                result = parseDate(dateString, dayFirst)
+            if cache and len(cache) >= cacheSize:
+                cache.popitem(last=False)
+        # Re-inserting keeps the most recently used strings at the end of the cache
+        cache[dateString] = result
+        yield result
+
+
+# Doesn't belong here but added for convenience
+def readCSVFile(filename, delim=',', dialect=None):
+    """ Read a CSV file. Return an array of data rows as dictionaries in {field_name: value} format. 
+    
+    Arguments:
+    filename - a path to the file to read
+    delim - CSV file delimiter
+    dialect - csv.Dialect object to use for parsing the file
+    
+    """
+    return list(iterCSVFile(filename, delim, dialect))
+
+def iterCSVFile(filename, delim=',', dialect=None, fields=None, chunkSize=None):
+    """ Read a CSV file row by row. Return a generator of data rows as dictionaries in {field_name: value} format.
+    
+    Arguments:
+    filename - a path to the file to read
+    delim - CSV file delimiter
+    dialect - csv.Dialect object to use for parsing the file
+    fields - a list of field names to keep, all fields are kept if not given
+    chunkSize - if given, lists of up to chunkSize rows are yielded instead of single rows
+    
+    Only the rows being processed are kept in memory, so files of any size can be converted.
+    
+    """
+    with open(filename, "r") as f:
+        if fields is None:
+            if dialect:
+                rows = csv.DictReader(f, dialect=dialect)
+            else:
+                rows = csv.DictReader(f, delimiter=delim)
+        else:
+            rows = _projectCSVRows(f, delim, dialect, fields, filename)
+        
+        if chunkSize is None:
+            for row in rows:
+                yield row
+        else:
+            while True:
+                chunk = list(itertools.islice(rows, chunkSize))
+                if not chunk:
+                    break
+                yield chunk
+
+def _projectCSVRows(f, delim, dialect, fields, filename):
+    """ Read CSV rows as dictionaries with the given fields only, without building a dictionary of all values """
+    if dialect:
+        reader = csv.reader(f, dialect=dialect)
+    else:
+        reader = csv.reader(f, delimiter=delim)
+    header = next(reader, [])
+    missing = [field for field in fields if field not in header]
+    if missing:
+        raise ValueError("No fields named %s in %s" % (", ".join(missing), filename))
+    columns = [header.index(field) for field in fields]
+    for values in reader:
+        if not values:
+            continue
+        # Missing values are set to None like in csv.DictReader
+        yield dict((field, values[i] if i < len(values) else None) for field, i in zip(fields, columns))
+
+def writeKML(doc, filename, processes=None, chunkSize=1000, compact=False):
+    """ Write a KML document to a file 
+        
+    Arguments:
+    doc - KMLDocument.document object to write
+    filename - kml output filename 
+    processes - number of worker processes used to serialize placemarks, the document is written by the calling
+                process if not given. It is limited to the number of CPUs and documents with fewer than
+                _parallelMinNodes elements are always written by the calling process, since starting workers and
+                passing their output back costs more than it saves there.
+    chunkSize - number of elements serialized by a worker process at a time
+    compact - whether the document should be written without indentation and newlines
+    
+    Coordinates are written with the precision set on the KMLDocument or on the elements when they were added.
+    The output is the same whether or not worker processes are used. Parallel writing relies on worker processes
+    forking from the calling one and isn't available on Windows.
+       
+    """
+    stats = getattr(doc, 'stats', None)
+    start = time.time()
+    fileOut = open(filename, "w")
+    if processes is not None:
+        processes = min(processes, _cpuCount())
+    parallel = processes is not None and processes >= 2 and sys.platform != 'win32'
+    if not (parallel and _writeParallel(doc, fileOut, processes, chunkSize, compact)):
+        _serializeDocument(doc, codecs.getwriter('UTF-8')(fileOut), compact)
+    if stats is not None:
+        stats.addWrite(time.time() - start, fileOut.tell())
+    fileOut.close()
+
+# Smallest number of nodes serialized by worker processes in writeKML, smaller documents are written serially
+_parallelMinNodes = 20000
+
+def _cpuCount():
+    """ Return the number of CPUs, or 1 if it can't be determined """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+# Tags of elements whose children are serialized separately by worker processes
+_containerTags = frozenset(['kml', 'Document', 'Folder'])
+
+# Nodes serialized by worker processes with indentation and newline strings. Set before the pool is created, so
+# workers inherit it when they fork.
+_parallelNodes = None
+
+def _openTag(node):
+    """ Return the opening tag of an element with its attributes, written the same way as Element.writexml """
+    out = StringIO.StringIO()
+    out.write("<" + node.tagName)
+    attrs = node._get_attributes()
+    for name in sorted(attrs.keys()):
+        out.write(" %s=\"" % name)
+        xdm._write_data(out, attrs[name].value)
+        out.write("\"")
+    out.write(">")
+    return out.getvalue()
+
+def _splitNodes(node, indent, items, nodes, addindent=INDENT, newl="\n"):
+    """ Flatten the container elements of the tree into literal tags and (node, indent) pairs of their children """
+    if node.nodeType == xdm.Node.ELEMENT_NODE and node.tagName in _containerTags and node.childNodes:
+        items.append(indent + _openTag(node) + newl)
+        for child in node.childNodes:
+            _splitNodes(child, indent + addindent, items, nodes, addindent, newl)
+        items.append("%s</%s>%s" % (indent, node.tagName, newl))
+    else:
+        items.append(len(nodes))
+        nodes.append((node, indent))
+
+def _serializeNodes(span):
+    """ Serialize a range of _parallelNodes. Return UTF-8 encoded string. """
+    out = cStringIO.StringIO()
+    writer = _BufferedWriter(codecs.getwriter('UTF-8')(out))
+    nodes, addindent, newl = _parallelNodes
+    for node, indent in nodes[span[0]:span[1]]:
+        _serializeNode(node, writer, indent, addindent, newl)
+    writer.flush()
+    return out.getvalue()
+
+def _writeParallel(doc, fileOut, processes, chunkSize, compact=False):
+    """ Write a DOM document serializing its elements in a pool of worker processes. Return False without writing
+        anything if the document has too few elements to be worth it.
+    """
+    global _parallelNodes
+    addindent, newl = _whitespace(compact)
+    items = []
+    nodes = []
+    for child in doc.childNodes:
+        _splitNodes(child, "", items, nodes, addindent, newl)
+    if len(nodes) < _parallelMinNodes:
+        return False
+    
+    # Join literal tags and split runs of consecutive nodes into chunks
+    parts = []
+    spans = []
+    for item in items:
+        if isinstance(item, basestring):
+            parts.append(item.encode('UTF-8'))
+        elif spans and parts[-1] is None and spans[-1][1] == item and item - spans[-1][0] < chunkSize:
+            spans[-1][1] = item + 1
+        else:
+            spans.append([item, item + 1])
+            parts.append(None)
+    
+    _parallelNodes = (nodes, addindent, newl)
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = pool.imap(_serializeNodes, spans)
+        fileOut.write('<?xml version="1.0" encoding="UTF-8"?>' + newl)
+        for part in parts:
+            fileOut.write(chunks.next() if part is None else part)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _parallelNodes = None
+    return True
+    
+def writeKMZ(doc, filename, level=6, bundleFiles=False, compact=False):
+    """ Write a KML document to a compressed KMZ file
+    
+    Arguments:
+    doc - KMLDocument.document object to write, or a path or a file object of an existing KML file (for example one
+          written with KMLStreamWriter)
+    filename - kmz output filename
+    level - zlib compression level from 1 (fastest) to 9 (smallest)
+    bundleFiles - whether local images referenced by href elements (Style icons, GroundOverlay icons) should be
+                  added to the archive. Only used when doc is a KMLDocument.document.
+    compact - whether the document should be written without indentation and newlines. Only used when doc is a
+              KMLDocument.document.
+    
+    The document is compressed as it is serialized, so the uncompressed KML is never held in memory. Archives larger
+    than 2 GB are written with zip64 extensions.
+    
+    """
+    stats = getattr(doc, 'stats', None)
+    start = time.time()
+    with contextlib.closing(zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True)) as kmz:
+        bundled = []
+        if isinstance(doc, basestring):
+            with open(doc, "rb") as f:
+                _writeKMZEntry(kmz, 'doc.kml', level, f)
+        elif hasattr(doc, 'read'):
+            _writeKMZEntry(kmz, 'doc.kml', level, doc)
+        else:
+            hrefs = bundleFiles and _localFiles(doc) or {}
+            saved = []
+            fragments = []
+            try:
+                for path, nodes in hrefs.items():
+                    name = "files/%s" % os.path.basename(path)
+                    if name in [bundledName for bundledName, bundledPath in bundled]:
+                        name = "files/%d_%s" % (len(bundled), os.path.basename(path))
+                    bundled.append((name, path))
+                    for node in nodes:
+                        saved.append((node, node.data))
+                        node.data = name
+                        # Styles are written from their changed nodes instead of the style cache
+                        parent = node.parentNode
+                        while parent is not None:
+                            if isinstance(parent, StyleFragment) and parent.element is not None:
+                                fragments.append((parent, parent.element))
+                                parent.element = None
+                            parent = parent.parentNode
+                _writeKMZEntry(kmz, 'doc.kml', level, doc, compact)
+            finally:
+                # Restore original paths, the document may still be written somewhere else
+                for node, data in saved:
+                    node.data = data
+                for fragment, element in fragments:
+                    fragment.element = element
+        for name, path in bundled:
+            kmz.write(path, name)
+    if stats is not None:
+        stats.addWrite(time.time() - start, os.path.getsize(filename))
+
+def _localFiles(doc):
+    """ Return a dictionary of local file paths referenced by href elements and lists of their text nodes """
+    hrefs = {}
+    for href in doc.getElementsByTagName('href'):
+        for node in href.childNodes:
+            if node.nodeType == xdm.Node.TEXT_NODE and "://" not in node.data and os.path.isfile(node.data):
+                hrefs.setdefault(os.path.abspath(node.data), []).append(node)
+    return hrefs
+
+def _writeKMZEntry(kmz, name, level, source, compact=False):
+    """ Add a compressed entry to a zip file, compressing the data as it is written.
+    
+    Arguments:
+    kmz - zipfile.ZipFile object opened for writing
+    name - entry name
+    level - zlib compression level
+    source - a DOM document to serialize or a file object to copy
+    compact - whether a DOM document should be written without indentation and newlines
+    
+    This follows ZipFile.write, which can't set the compression level or take data that is generated on the fly.
+    The header has room for zip64 sizes unless the source is a file known to be small enough, as the header is
+    written before the size of the data is known.
+    
+    """
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0644 << 16L
+    info.header_offset = kmz.fp.tell()
+    info.CRC = info.compress_size = info.file_size = 0
+    size = _remainingSize(source) if hasattr(source, 'read') else None
+    zip64 = size is None or size * 1.05 > zipfile.ZIP64_LIMIT
+    kmz.fp.write(info.FileHeader(zip64))
+    
+    entry = _DeflateWriter(kmz.fp, level)
+    if hasattr(source, 'read'):
+        while True:
+            data = source.read(1024 * 64)
+            if not data:
+                break
+            entry.write(data)
+    else:
+        _serializeDocument(source, codecs.getwriter('UTF-8')(entry), compact)
+    entry.close()
+    
+    info.CRC = entry.crc
+    info.compress_size = entry.compressSize
+    info.file_size = entry.size
+    # Seek back and rewrite the header with the sizes and CRC, in the same space
+    position = kmz.fp.tell()
+    kmz.fp.seek(info.header_offset, 0)
+    kmz.fp.write(info.FileHeader(zip64))
+    kmz.fp.seek(position, 0)
+    kmz.filelist.append(info)
+    kmz.NameToInfo[info.filename] = info
+    kmz._didModify = True
+
+def _remainingSize(f):
+    """ Return number of bytes left to read from a file object, or None if it can't be told """
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+class _DeflateWriter:
+    """ File-like object compressing everything written to it into another file object """
+    
+    def __init__(self, fileOut, level):
+        self.fileOut = fileOut
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.crc = 0
+        self.size = 0
+        self.compressSize = 0
+        
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        data = self.compressor.compress(data)
+        self.compressSize += len(data)
+        self.fileOut.write(data)
+        
+    def close(self):
+        data = self.compressor.flush()
+        self.compressSize += len(data)
+        self.fileOut.write(data)
+
+def writeTiledKML(doc, outdir, maxPerTile=1000, minLodPixels=128, processes=None, maxDepth=24, compact=False):
+    """ Write a document as a set of spatially tiled KML files with Regions. Return the path of the root file.
+    
+    Arguments:
+    doc - LazyKMLDocument or a sequence of element objects
+    outdir - output directory, created if it doesn't exist
+    maxPerTile - maximum number of placemarks in a single tile
+    minLodPixels - size in pixels a tile needs to take on the screen before it's loaded
+    processes - number of worker processes writing tiles, tiles are written by the calling process if not given
+    maxDepth - maximum depth of the quadtree, tiles at this depth can have more than maxPerTile placemarks
+    compact - whether the files should be written without indentation and newlines
+    
+    Placemarks are divided with a quadtree over their coordinates. Every leaf of the tree is written to its own file
+    with a Region, and every other node to a file with NetworkLinks to its children, so viewers only load tiles
+    that are visible. The root file (doc.kml) links to the top tile. Styles and schemas are repeated in every tile.
+    Folders aren't kept, placemarks of a tile are written directly to its document.
+    
+    """
+    global _tileJobs
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    elements = doc.iterElements() if isinstance(doc, LazyKMLDocument) else doc
+    styles = []
+    items = []
+    for element in elements:
+        if isinstance(element, (Style, StyleMap, Schema)):
+            styles.append(element)
+        elif isinstance(element, PointBatch):
+            for point in element.points():
+                items.append((point.lat, point.lon, point))
+        elif not isinstance(element, Folder):
+            bounds = _elementBounds(element)
+            if bounds is not None:
+                south, west, north, east = bounds
+                items.append(((south + north) / 2.0, (west + east) / 2.0, element))
+    
+    title = doc.title if isinstance(doc, LazyKMLDocument) else os.path.basename(os.path.abspath(outdir))
+    tiles = _quadtree(items, maxPerTile, maxDepth)
+    _tileJobs = (outdir, title, styles, tiles, dict((tile[0], tile[1]) for tile in tiles), minLodPixels, compact, StyleCache())
+    try:
+        if processes is None or processes < 2 or sys.platform == 'win32':
+            for index in xrange(len(tiles)):
+                _writeTile(index)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                pool.map(_writeTile, xrange(len(tiles)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        _tileJobs = None
+    
+    root = os.path.join(outdir, "doc.kml")
+    with KMLStreamWriter(root, title, compact=compact) as out:
+        if tiles:
+            key, bounds, children, elements = tiles[0]
+            out.addElement(NetworkLink("%s.kml" % key, region=Region(*bounds, minLodPixels=minLodPixels)))
+    return root
+
+# Tiles written by worker processes: (outdir, title, styles, tiles, tile bounds by key, minLodPixels, compact, style
+# cache). Set before the pool is created, so workers inherit it when they fork.
+_tileJobs = None
+
+def _quadtree(items, maxPerTile, maxDepth):
+    """ Divide (lat, lon, element) items with a quadtree.
+    
+    Return a list of (key, (north, south, east, west), childKeys, elements) tiles, the root tile first. Keys are
+    quadkeys of the tiles, 't' for the root.
+    
+    """
+    if not items:
+        return []
+    lats = [item[0] for item in items]
+    lons = [item[1] for item in items]
+    # Boxes of points sharing a latitude or longitude are widened, a Region without area is never shown
+    south, north = _padExtent(min(lats), max(lats), 90.0)
+    west, east = _padExtent(min(lons), max(lons), 180.0)
+    tiles = []
+    stack = [('t', north, south, east, west, items)]
+    while stack:
+        key, north, south, east, west, tileItems = stack.pop()
+        if len(tileItems) <= maxPerTile or len(key) > maxDepth or _samePosition(tileItems):
+            tiles.append((key, (north, south, east, west), [], [item[2] for item in tileItems]))
+            continue
+        midLat = (north + south) / 2.0
+        midLon = (east + west) / 2.0
+        quadrants = [[], [], [], []]
+        for item in tileItems:
+            quadrants[(item[0] < midLat) * 2 + (item[1] >= midLon)].append(item)
+        bounds = [(north, midLat, midLon, west), (north, midLat, east, midLon),
+                  (midLat, south, midLon, west), (midLat, south, east, midLon)]
+        children = []
+        for i in xrange(4):
+            if quadrants[i]:
+                children.append(key + str(i))
+                stack.append((key + str(i),) + bounds[i] + (quadrants[i],))
+        tiles.append((key, (north, south, east, west), children, []))
+    tiles.sort(key=lambda tile: (len(tile[0]), tile[0]))
+    return tiles
+
+# Smallest width and height of a tile in degrees, about 100 m
+_minTileSize = 0.001
+
+def _padExtent(low, high, limit):
+    """ Return a range of coordinates widened to at least _minTileSize, within -limit and limit """
+    if high - low >= _minTileSize:
+        return low, high
+    # Shifted back inside the limits at the edges of the map
+    low = min(max((low + high - _minTileSize) / 2.0, -limit), limit - _minTileSize)
+    return low, low + _minTileSize
+
+def _samePosition(items):
+    """ Return True if all (lat, lon, element) items are at the same position and can't be divided any further """
+    lat, lon = items[0][:2]
+    for item in items:
+        if item[0] != lat or item[1] != lon:
+            return False
+    return True
+
+def _writeTile(index):
+    """ Write a single tile of _tileJobs """
+    outdir, title, styles, tiles, tileBounds, minLodPixels, compact, cache = _tileJobs
+    key, bounds, children, elements = tiles[index]
+    with KMLStreamWriter(os.path.join(outdir, "%s.kml" % key), "%s %s" % (title, key), compact=compact, styleCache=cache) as out:
+        out.addElements(*styles)
+        out.addElement(Region(*bounds, minLodPixels=minLodPixels))
+        for child in children:
+            out.addElement(NetworkLink("%s.kml" % child, region=Region(*tileBounds[child], minLodPixels=minLodPixels)))
+        for element in elements:
+            out.addElement(element)
+
+def clusterPoints(latitudes, longitudes, minLevel=2, maxLevel=18):
+    """ Group points into clusters on the grids of a range of levels. Return clusters of every level, coarsest first.
+    
+    Arguments:
+    latitudes - a sequence of latitudes (list, array.array or numpy array)
+    longitudes - a sequence of longitudes
+    minLevel - the coarsest level
+    maxLevel - the finest level, at most 30
+    
+    Cells of level z are 360 / 2**z degrees wide, the width of a map tile at zoom level z. Points are sorted once by
+    the Z-order code of their cell on the finest grid. In that order the cells of every coarser level are runs of
+    consecutive cells of the level below, so clusters of all levels are merged without sorting again. Clustering
+    takes O(n log n) time with all steps vectorized (requires numpy).
+    
+    Clusters of a level are a dictionary with the level and numpy arrays of rows and columns of the cells, numbers
+    of points, mean latitudes and longitudes, and the index of the first point of every cell. Cells are in Z-order.
+    
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for clustering")
+    if not 0 <= minLevel <= maxLevel <= 30:
+        raise ValueError("Levels must be between 0 and 30")
+    lats = numpy.asarray(latitudes, dtype=float)
+    lons = numpy.asarray(longitudes, dtype=float)
+    rows, columns = _gridCells(lats, lons, maxLevel)
+    codes = (_spreadBits(rows) << 1) | _spreadBits(columns)
+    # The sort needn't be stable, the first point of a cell is the smallest index taken by minimum.reduceat
+    order = numpy.argsort(codes)
+    codes, rows, columns = codes[order], rows[order], columns[order]
+    first = order
+    counts = numpy.ones(len(order), dtype=numpy.int64)
+    latSums, lonSums = lats[order], lons[order]
+    levels = []
+    for level in xrange(maxLevel, minLevel - 1, -1):
+        if level < maxLevel:
+            codes, rows, columns = codes >> 2, rows >> 1, columns >> 1
+        starts = numpy.flatnonzero(numpy.diff(codes)) + 1
+        if len(codes):
+            starts = numpy.r_[0, starts]
+            codes, rows, columns = codes[starts], rows[starts], columns[starts]
+            counts = numpy.add.reduceat(counts, starts)
+            latSums = numpy.add.reduceat(latSums, starts)
+            lonSums = numpy.add.reduceat(lonSums, starts)
+            first = numpy.minimum.reduceat(first, starts)
+        levels.append({'level': level, 'rows': rows, 'columns': columns, 'counts': counts,
+                       'lats': latSums / counts, 'lons': lonSums / counts, 'first': first})
+    levels.reverse()
+    return levels
+
+def _spreadBits(values):
+    """ Return int64 values with bits spread to even positions, for interleaving into Z-order codes """
+    values = values & 0xFFFFFFFF
+    values = (values | (values << 16)) & 0x0000FFFF0000FFFF
+    values = (values | (values << 8)) & 0x00FF00FF00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F0F0F0F0F
+    values = (values | (values << 2)) & 0x3333333333333333
+    return (values | (values << 1)) & 0x5555555555555555
+
+def _gridCells(lats, lons, level):
+    """ Return rows and columns of grid cells of a level containing the given points, as int64 arrays """
+    cells = 2 ** level
+    size = 360.0 / cells
+    rows = numpy.floor((lats + 90.0) / size).astype(numpy.int64)
+    columns = numpy.floor((lons + 180.0) / size).astype(numpy.int64)
+    # Points on the north and east edges of the map are put in the last row and column. The single cell of level 0
+    # spans all latitudes.
+    return numpy.clip(rows, 0, max(cells // 2, 1) - 1), numpy.clip(columns, 0, cells - 1)
+
+def _tileGroups(rows, columns, shift):
+    """ Return an order grouping cells by tiles of 2**shift by 2**shift cells, and tile rows, columns and boundaries """
+    tileRows, tileColumns = rows >> shift, columns >> shift
+    order = numpy.argsort((tileRows << 32) | tileColumns, kind='mergesort')
+    tileRows, tileColumns = tileRows[order], tileColumns[order]
+    if len(order) == 0:
+        return order, tileRows, tileColumns, []
+    starts = numpy.r_[0, numpy.flatnonzero((numpy.diff(tileRows) != 0) | (numpy.diff(tileColumns) != 0)) + 1]
+    ends = numpy.r_[starts[1:], len(order)]
+    return order, tileRows[starts], tileColumns[starts], zip(starts.tolist(), ends.tolist())
+
+def _tileRegion(level, shift, row, column, minLodPixels, maxLodPixels):
+    """ Return a Region of a tile of 2**shift by 2**shift cells of a level """
+    size = 360.0 / 2 ** (level - shift)
+    south = row * size - 90.0
+    west = column * size - 180.0
+    return Region(min(south + size, 90.0), south, min(west + size, 180.0), west, minLodPixels, maxLodPixels)
+
+# Icon of cluster placemarks of the default cluster styles
+CLUSTER_ICON = "http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png"
+
+def clusterStyles(icon=CLUSTER_ICON, prefix="cluster"):
+    """ Return default cluster styles for writeClusteredKML, with icons growing with every power of ten of points """
+    return [Style("%s%d" % (prefix, i), icon={'icon': icon, 'scale': str(1.0 + 0.4 * i)}) for i in xrange(4)]
+
+def writeClusteredKML(filename, latitudes, longitudes, names=None, styles=None, title="", elements=(), minLevel=2, maxLevel=18, cellPixels=64, tileCells=8, clusterStyleList=None, precision=None, compact=False):
+    """ Write points as clusters of every zoom level, with single points only shown when zoomed in.
+    
+    Arguments:
+    filename - kml output filename
+    latitudes - a sequence of latitudes (list, array.array or numpy array)
+    longitudes - a sequence of longitudes
+    names - a sequence of point names
+    styles - a sequence of style ids or a single style id used for all points
+    title - document title
+    elements - Style, StyleMap and Schema objects used by the points, written first
+    minLevel - the coarsest clustering level, see clusterPoints
+    maxLevel - the finest clustering level, single points are shown when zoomed in further
+    cellPixels - size of a grid cell on the screen in pixels at which clusters of the next level are shown
+    tileCells - width of a tile in cells, a power of two. Clusters and points of a tile are written to a folder with
+                a Region, so viewers only show the tiles that are visible and at the right zoom.
+    clusterStyleList - Style objects of clusters of up to 9, 99, 999... points, the last one is used for larger
+                       clusters. clusterStyles() is used if not given.
+    precision - number of decimals of coordinates, see formatCoordinates
+    compact - whether the file should be written without indentation and newlines
+    
+    Every level is written to a folder with clusters named with their numbers of points, placed at the mean position
+    of their points. A cluster of a single point is written as the point itself. Clusters of level z are shown when
+    their cell takes between cellPixels and 2 * cellPixels on the screen (the coarsest level when it's smaller too),
+    and single points when cells of maxLevel take more. Points and clusters are written with PointBatch, so the
+    output is the same as for Point objects.
+    
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for clustering")
+    shift = int(round(math.log(tileCells, 2)))
+    if 2 ** shift != tileCells:
+        raise ValueError("tileCells must be a power of two")
+    if clusterStyleList is None:
+        clusterStyleList = clusterStyles()
+    clusterIds = numpy.array([style.id for style in clusterStyleList], dtype=object)
+    levels = clusterPoints(latitudes, longitudes, minLevel, maxLevel)
+    lats = numpy.asarray(latitudes, dtype=float)
+    lons = numpy.asarray(longitudes, dtype=float)
+    names = numpy.asarray(names, dtype=object) if names is not None else None
+    if styles is not None and not isinstance(styles, basestring):
+        styles = numpy.asarray(styles, dtype=object)
+    
+    def pointValues(column, index):
+        """ Return values of a point column for the given points """
+        if column is None or isinstance(column, basestring):
+            return column
+        return column[index]
+    
+    with KMLStreamWriter(filename, title, compact=compact) as out:
+        out.addElements(*(list(elements) + list(clusterStyleList)))
+        lod = cellPixels * tileCells
+        for clusters in levels:
+            level = clusters['level']
+            counts = clusters['counts']
+            # Names and styles of clusters, or of the point of single point clusters
+            single = counts == 1
+            clusterNames = numpy.array([str(count) for count in counts.tolist()], dtype=object)
+            clusterStyleIds = clusterIds[numpy.minimum(numpy.log10(counts).astype(int), len(clusterIds) - 1)]
+            if names is not None:
+                clusterNames[single] = names[clusters['first'][single]]
+            else:
+                clusterNames[single] = ""
+            if styles is None or isinstance(styles, basestring):
+                clusterStyleIds[single] = styles
+            else:
+                clusterStyleIds[single] = styles[clusters['first'][single]]
+            
+            order, tileRows, tileColumns, groups = _tileGroups(clusters['rows'], clusters['columns'], shift)
+            with out.folder("Level %d" % level):
+                for tileRow, tileColumn, (start, end) in zip(tileRows.tolist(), tileColumns.tolist(), groups):
+                    region = _tileRegion(level, shift, tileRow, tileColumn, lod if level > minLevel else 0, 2 * lod)
+                    index = order[start:end]
+                    with out.folder("%d/%d/%d" % (level, tileRow, tileColumn), region):
+                        out.addElement(PointBatch(clusters['lats'][index], clusters['lons'][index], clusterNames[index],
+                                                  styles=clusterStyleIds[index], precision=precision))
+        
+        # Single points, grouped by tiles of the finest level
+        rows, columns = _gridCells(lats, lons, maxLevel)
+        order, tileRows, tileColumns, groups = _tileGroups(rows, columns, shift)
+        with out.folder("Points"):
+            for tileRow, tileColumn, (start, end) in zip(tileRows.tolist(), tileColumns.tolist(), groups):
+                region = _tileRegion(maxLevel, shift, tileRow, tileColumn, 2 * lod, -1)
+                index = order[start:end]
+                with out.folder("%d/%d/%d" % (maxLevel, tileRow, tileColumn), region):
+                    out.addElement(PointBatch(lats[index], lons[index], pointValues(names, index),
+                                              styles=pointValues(styles, index), precision=precision))
+
+def writeTimeShardedKML(doc, outdir, window='day', maxOpenFiles=32, compact=False):
+    """ Write a document as a set of KML files, one per time window, and an index file linking them.
+    
+    Return the path of the index file.
+    
+    Arguments:
+    doc - LazyKMLDocument or an iterable of element objects
+    outdir - output directory, created if it doesn't exist
+    window - 'hour', 'day' or length of a window as datetime.timedelta or a number of seconds
+    maxOpenFiles - maximum number of shard files kept open at the same time
+    compact - whether the files should be written without indentation and newlines
+    
+    Placemarks are assigned to windows by their TimeStamp, TimeSpan begin or the first date of a Track. Placemarks
+    without dates are written to static.kml, which is always shown. The index file (doc.kml) has a NetworkLink with
+    a TimeSpan for every window, so viewers only load files of the active period. Styles and schemas are repeated
+    in every shard, so they should come before placemarks.
+    
+    Elements are written in a single pass. Time sorted input only needs a single open file; for unsorted input the
+    least recently used shards are closed and reopened for appending when they're needed again.
+    
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    title = doc.title if isinstance(doc, LazyKMLDocument) else os.path.basename(os.path.abspath(outdir))
+    elements = doc.iterElements() if isinstance(doc, LazyKMLDocument) else doc
+    if window not in ('hour', 'day') and not isinstance(window, datetime.timedelta):
+        window = datetime.timedelta(seconds=window)
+    
+    styles = []
+    # Window start -> (filename, window end), and the shards that are open at the moment
+    shards = {}
+    registries = {}
+    # Styles are the same in every shard
+    cache = StyleCache()
+    openShards = collections.OrderedDict()
+    
+    def shardWriter(start):
+        """ Return an open KMLStreamWriter for the window starting at start """
+        out = openShards.pop(start, None)
+        if out is None:
+            if start in shards:
+                out = KMLStreamWriter(os.path.join(outdir, shards[start][0]), title, header=False,
+                                      styleRegistry=registries[start], compact=compact, styleCache=cache)
+            else:
+                if start is None:
+                    filename, end = "static.kml", None
+                else:
+                    end = _windowEnd(start, window)
+                    filename = "shard_%s.kml" % start.strftime("%Y%m%dT%H%M%S")
+                shards[start] = (filename, end)
+                out = KMLStreamWriter(os.path.join(outdir, filename), title, compact=compact, styleCache=cache)
+                out.addElements(*styles)
+                registries[start] = out.styleRegistry
+            if len(openShards) >= maxOpenFiles:
+                openShards.popitem(last=False)[1].detach()
+        openShards[start] = out
+        return out
+    
+    try:
+        for element in elements:
+            if isinstance(element, (Style, StyleMap, Schema)):
+                styles.append(element)
+            elif isinstance(element, PointBatch):
+                for point in element.points():
+                    shardWriter(_windowStart(point, window)).addElement(point)
+            elif not isinstance(element, Folder):
+                shardWriter(_windowStart(element, window)).addElement(element)
+    finally:
+        for out in openShards.values():
+            out.detach()
+    
+    # Every shard is finished by writing its closing tags
+    for start, (filename, end) in shards.items():
+        KMLStreamWriter(os.path.join(outdir, filename), title, header=False, compact=compact).close()
+    
+    index = os.path.join(outdir, "doc.kml")
+    with KMLStreamWriter(index, title, compact=compact) as out:
+        for start in sorted(shards, key=lambda start: (start is not None, start)):
+            filename, end = shards[start]
+            if start is None:
+                out.addElement(NetworkLink(filename, name="static"))
+            else:
+                begin = start.isoformat() + "Z"
+                out.addElement(NetworkLink(filename, name=begin, startDate=begin, endDate=end.isoformat() + "Z"))
+    return index
+
+def _elementDates(element):
+    """ Return first and last date strings of an element, from its TimeStamp, TimeSpan or the whens of a Track.
+    
+    Dates an element doesn't have are "", e.g. the last date of a TimeSpan without an end.
+    
+    """
+    if isinstance(element, Track):
+        whens = element.whens
+        if whens is None or len(whens) == 0:
+            return "", ""
+        return whens[0], whens[len(whens) - 1]
+    if isinstance(element, Point) and element.dt:
+        return element.dt, element.dt
+    return getattr(element, 'sdt', "") or "", getattr(element, 'edt', "") or ""
+
+def _elementTime(element):
+    """ Return the first date string of an element, or "" if it doesn't have one """
+    return _elementDates(element)[0]
+
+def _windowStart(element, window):
+    """ Return start of the time window of an element as a naive UTC datetime, or None if it has no date """
+    dateString = _elementTime(element)
+    if not dateString:
+        return None
+    dt = _parseTime(dateString)
+    if window == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    if window == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    seconds = _totalSeconds(window)
+    offset = _totalSeconds(dt - _epoch)
+    return _epoch + datetime.timedelta(seconds=offset - offset % seconds)
+
+def _windowEnd(start, window):
+    """ Return end of the time window starting at start """
+    if window == 'hour':
+        return start + datetime.timedelta(hours=1)
+    if window == 'day':
+        return start + datetime.timedelta(days=1)
+    return start + window
+
+_epoch = datetime.datetime(1970, 1, 1)
+_isoTime = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?Z?\Z')
+
+def _parseTime(dateString):
+    """ Parse a KML date string to a naive UTC datetime """
+    match = _isoTime.match(dateString)
+    if match is None:
+        dt = dtparser.parse(dateString)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+        return dt
+    values = match.groups()
+    return datetime.datetime(int(values[0]), int(values[1]), int(values[2]), int(values[3] or 0), int(values[4] or 0),
+                             int(values[5] or 0), int((values[6] or '0').ljust(6, '0')))
+
+def _totalSeconds(delta):
+    """ Return number of seconds in a datetime.timedelta """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def _elementBounds(element):
+    """ Return (south, west, north, east) bounds of a placemark or overlay, or None if it has no coordinates """
+    if isinstance(element, Point):
+        lat = float(element.lat)
+        lon = float(element.lon)
+        return lat, lon, lat, lon
+    if isinstance(element, GroundOverlay):
+        return float(element.south), float(element.west), float(element.north), float(element.east)
+    if isinstance(element, Polygon) and element.coordinates is not None:
+        lats = []
+        lons = []
+        for line in element.coordinates.split("\n"):
+            values = line.split(",")
+            if len(values) >= 2:
+                lons.append(float(values[0]))
+                lats.append(float(values[1]))
+    elif isinstance(element, (Path, Polygon, Track)):
+        lats = element.lats
+        lons = element.lons
+    else:
+        return None
+    if len(lats) == 0:
+        return None
+    return float(min(lats)), float(min(lons)), float(max(lats)), float(max(lons))
+        
+def printKML(doc):
+    """ Print a KML document to the teminal """
+    out = cStringIO.StringIO()
+    _serializeDocument(doc, codecs.getwriter('UTF-8')(out))
+    print out.getvalue()
+    
+def getText(nodelist):
+    """ Get string from text nodes """
+    txt = []
+    for node in nodelist:
+        if node.nodeType == node.TEXT_NODE:
+            txt.append(node.data)
+    return "".join(txt)
+
+def _escape(text):
+    """ Escape text the same way minidom does when writing it """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def _escapeFormat(text):
+    """ Escape text for XML and % signs for string formatting, for text put into templates """
+    return _escape(text).replace("%", "%%")
+
+def _toList(values):
+    """ Return a sequence (list, array.array, numpy array) as a list of plain python values """
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
+
+def _coordinateList(values):
+    """ Return a sequence of coordinates as a list of values written by PointBatch the same way as by Point.
+    
+    Floats of numpy arrays are kept as numpy scalars, which are written in full, while plain python floats are cut
+    to 12 significant digits.
+    
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray) and values.dtype.kind == 'f':
+        return list(values)
+    return _toList(values)
+
+def _coordinateValue(value):
+    """ Return a single coordinate as a plain python value, or as a numpy scalar for numpy floats, see _coordinateList """
+    if hasattr(value, 'item') and not (numpy is not None and isinstance(value, numpy.floating)):
+        return value.item()
+    return value
+
+def formatCoordinates(lats, lons, alts=None, precision=None):
+    """ Format a <coordinates> block as a single string with one 'longitude, latitude, altitude' tuple per line.
+    
+    Arguments:
+    lats - a sequence of latitudes (list, array.array or numpy array)
+    lons - a sequence of longitudes
+    alts - an optional sequence of altitudes, 0 is used if not given
+    precision - number of decimals, values are written in full if not given. With precision tuples are written
+                as 'longitude,latitude,altitude' without spaces and trailing zeros are left out.
+    
+    """
+    # Numpy floats are written in full without a precision, the same way as by Point and PointBatch
+    toList = _coordinateList if precision is None else _toList
+    lats = toList(lats)
+    lons = toList(lons)
+    number = "%s" if precision is None else "%%.%df" % precision
+    separator = ", " if precision is None else ","
+    if alts is None or len(alts) == 0:
+        n = min(len(lats), len(lons))
+        template = number + separator + number + separator + "0"
+        values = [None] * (2 * n)
+        values[0::2] = lons[:n]
+        values[1::2] = lats[:n]
+    else:
+        alts = toList(alts)
+        n = min(len(lats), len(lons), len(alts))
+        template = separator.join([number] * 3)
+        values = [None] * (3 * n)
+        values[0::3] = lons[:n]
+        values[1::3] = lats[:n]
+        values[2::3] = alts[:n]
+    # A single formatting operation for the whole block is much faster than formatting vertex by vertex
+    text = "\n".join([template] * n) % tuple(values)
+    if precision is not None:
+        text = _stripZeros(text)
+    return text
+
+def formatNumber(value, precision=None):
+    """ Format a number with the given number of decimals without trailing zeros, or in full if precision is None """
+    if precision is None:
+        return str(value)
+    return _stripZeros("%.*f" % (precision, float(value)))
+
+# Trailing zeros of decimal numbers and decimal points left without decimals
+_trailingZeros = re.compile(r'(\.[0-9]*?)0+(?![0-9])')
+_trailingPoint = re.compile(r'\.(?![0-9])')
+# Negative numbers rounded to zero
+_negativeZero = re.compile(r'(?<![0-9.])-0(?![0-9.])')
+
+def _stripZeros(text):
+    """ Remove trailing zeros from all decimal numbers in text, and the sign of numbers rounded to zero """
+    return _negativeZero.sub('0', _trailingPoint.sub('', _trailingZeros.sub(r'\1', text)))
+
+def simplify(lats, lons, tolerance, method="douglas-peucker", ring=False):
+    """ Simplify a line. Return a sorted numpy array of indices of the vertices to keep.
+    
+    Arguments:
+    lats - a sequence of latitudes (list, array.array or numpy array)
+    lons - a sequence of longitudes
+    tolerance - in metres. For douglas-peucker the maximum distance of a removed vertex from the simplified line, for
+                visvalingam the square root of the smallest triangle area kept.
+    method - douglas-peucker or visvalingam
+    ring - whether the line is a closed polygon boundary, the vertex furthest from the first one is then always kept
+    
+    Coordinates are projected to metres with a local equirectangular projection. Both methods work on whole arrays
+    at a time: douglas-peucker splits all segments of a level in one step and visvalingam removes all vertices with
+    the smallest local areas in one step, so neither uses recursion. Requires numpy.
+    
+    """
+    if numpy is None:
+        raise ImportError("numpy is required for simplification")
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    n = min(len(lats), len(lons))
+    if n < 3:
+        return numpy.arange(n)
+    lats = lats[:n]
+    lons = lons[:n]
+    scale = numpy.pi / 180.0 * _earthRadius
+    y = lats * scale
+    x = lons * scale * numpy.cos(numpy.radians(lats.mean()))
+    if method == "douglas-peucker":
+        return _douglasPeucker(x, y, float(tolerance), ring)
+    elif method == "visvalingam":
+        return _visvalingam(x, y, float(tolerance) ** 2, ring)
+    raise ValueError("Unknown simplification method %s" % method)
+
+# Mean Earth radius in metres
+_earthRadius = 6371008.8
+
+def _ringSplit(x, y):
+    """ Return index of the vertex furthest from the first one """
+    return int(numpy.argmax((x - x[0]) ** 2 + (y - y[0]) ** 2))
+
+# Number of vertices in the chunks simplified separately by _douglasPeucker
+_simplifyChunk = 4096
+
+def _douglasPeucker(x, y, tolerance, ring):
+    """ Douglas-Peucker simplification of projected coordinates processing a whole level of segments at a time """
+    n = len(x)
+    # Long lines are split into chunks first. The first levels would otherwise process all vertices only to find
+    # splits that are certain anyway, at the cost of a vertex kept at every chunk boundary.
+    bounds = [0, n - 1]
+    if ring:
+        bounds.append(_ringSplit(x, y))
+    bounds = numpy.unique(numpy.concatenate((bounds, numpy.arange(0, n, _simplifyChunk))))
+    keep = numpy.zeros(n, dtype=bool)
+    keep[bounds] = True
+    # Chunks are independent, processing a few of them at a time keeps the arrays in the processor cache
+    for block in xrange(0, len(bounds) - 1, 8):
+        _douglasPeuckerLevels(x, y, tolerance * tolerance, keep, bounds[block:block + 9])
+    return numpy.flatnonzero(keep)
+
+def _douglasPeuckerLevels(x, y, tolerance, keep, bounds):
+    """ Simplify lines between consecutive bounds, marking kept vertices in keep. Tolerance is squared. """
+    starts = bounds[:-1]
+    ends = bounds[1:]
+    while True:
+        counts = ends - starts - 1
+        active = counts > 0
+        starts, ends, counts = starts[active], ends[active], counts[active]
+        if not len(starts):
+            break
+        # Segment vectors, the first vertex and inverse squared length of every segment
+        ax = x[starts]
+        ay = y[starts]
+        dx = x[ends] - ax
+        dy = y[ends] - ay
+        length = dx * dx + dy * dy
+        inverse = 1.0 / numpy.where(length > 0, length, 1.0)
+        # Interior vertices of all segments, with the segment each of them belongs to
+        offsets = numpy.cumsum(counts) - counts
+        segments = numpy.repeat(numpy.arange(len(starts)), counts)
+        index = numpy.arange(len(segments))
+        index += numpy.repeat(starts + 1 - offsets, counts)
+        # Squared distance to the segment between its end vertices
+        sdx = dx[segments]
+        sdy = dy[segments]
+        px = x[index]
+        px -= ax[segments]
+        py = y[index]
+        py -= ay[segments]
+        t = px * sdx
+        t += py * sdy
+        t *= inverse[segments]
+        numpy.clip(t, 0.0, 1.0, out=t)
+        sdx *= t
+        sdy *= t
+        px -= sdx
+        py -= sdy
+        px *= px
+        py *= py
+        distance = px
+        distance += py
+        # Furthest vertex of every segment, the first one if there are many
+        furthest = numpy.maximum.reduceat(distance, offsets)
+        candidates = numpy.flatnonzero(distance == furthest[segments])
+        candidateSegments = segments[candidates]
+        first = candidates[numpy.concatenate(([True], candidateSegments[1:] != candidateSegments[:-1]))]
+        split = furthest > tolerance
+        mids = index[first][split]
+        keep[mids] = True
+        starts, ends = numpy.concatenate((starts[split], mids)), numpy.concatenate((mids, ends[split]))
+
+def _visvalingam(x, y, minArea, ring):
+    """ Visvalingam-Whyatt simplification of projected coordinates removing many vertices at a time.
+    
+    Every step removes the vertices whose triangle area is below minArea and smaller than the areas of both
+    neighbours, so no two neighbouring vertices are removed in the same step.
+    
+    """
+    kept = numpy.arange(len(x))
+    fixed = numpy.zeros(len(x), dtype=bool)
+    fixed[0] = fixed[-1] = True
+    if ring:
+        fixed[_ringSplit(x, y)] = True
+    while len(kept) > 2:
+        kx = x[kept]
+        ky = y[kept]
+        area = numpy.empty(len(kept))
+        area[0] = area[-1] = numpy.inf
+        area[1:-1] = 0.5 * numpy.abs((kx[:-2] - kx[2:]) * (ky[1:-1] - ky[:-2]) - (kx[:-2] - kx[1:-1]) * (ky[2:] - ky[:-2]))
+        area[fixed[kept]] = numpy.inf
+        remove = numpy.zeros(len(kept), dtype=bool)
+        remove[1:-1] = (area[1:-1] < minArea) & (area[1:-1] < area[:-2]) & (area[1:-1] <= area[2:])
+        if not remove.any():
+            break
+        kept = kept[~remove]
+    return kept
+
+def _simplifyArrays(lats, lons, alts, tolerance, method, ring=False):
+    """ Simplify coordinate arrays. Return simplified lats, lons, alts and a tuple of vertex counts before and after. """
+    index = simplify(lats, lons, tolerance, method, ring)
+    before = min(len(lats), len(lons))
+    lats = _take(lats, index)
+    lons = _take(lons, index)
+    if alts is not None and len(alts) > 0:
+        alts = _take(alts, index[index < len(alts)])
+    return lats, lons, alts, (before, len(index))
+
+def _take(values, index):
+    """ Return values at the given indices, as a list unless values are a numpy array, so they are written the same
+    way as the values they were taken from """
+    if isinstance(values, numpy.ndarray):
+        return values[index]
+    return [values[i] for i in index.tolist()]
+
+def _parseCoordinates(coordinates):
+    """ Parse a <coordinates> string to lists of latitudes, longitudes and altitudes """
+    lats, lons, alts = [], [], []
+    for line in coordinates.strip().splitlines():
+        values = [float(value) for value in line.split(',')]
+        lons.append(values[0])
+        lats.append(values[1])
+        alts.append(values[2] if len(values) > 2 else 0.0)
+    return lats, lons, alts
+
+def _writeText(writer, tag, text, indent, newl="\n"):
+    """ Write a single text element the same way Element.writexml does """
+    writer.write("%s<%s>" % (indent, tag))
+    xdm._write_data(writer, text)
+    writer.write("</%s>%s" % (tag, newl))
+
+def _elementNode(element, precision=None):
+    """ Return the DOM node of an element object, with the given precision if the element takes one """
+    if precision is not None and hasattr(element, 'precision'):
+        return element.kml(precision).documentElement
+    return element.kml().documentElement
+
+def _writeElement(writer, element, depth, stats=None, styles=None, addindent=INDENT, newl="\n", cache=None, precision=None):
+    """ Serialize a single element object at the given nesting depth.
+    
+    Styles are written from a StyleCache if one is given. References to collapsed styles are rewritten if a
+    StyleRegistry is given. Elements without a precision of their own are written with the given precision.
+    
+    """
+    if cache is not None and isinstance(element, (Style, StyleMap)):
+        start = time.time() if stats is not None else None
+        writer.write(cache.text(element, addindent * depth, addindent, newl))
+        if stats is not None:
+            stats.addElement(element, None, 0.0)
+            stats.serializeTime += time.time() - start
+        return
+    out = _BufferedWriter(writer)
+    if stats is None:
+        node = _elementNode(element, precision)
+        if styles is not None:
+            styles.rewrite(node)
+        _serializeNode(node, out, addindent * depth, addindent, newl)
+    else:
+        start = time.time()
+        node = _elementNode(element, precision)
+        if styles is not None:
+            styles.rewrite(node)
+        built = time.time()
+        _serializeNode(node, out, addindent * depth, addindent, newl)
+        stats.addElement(element, node, built - start)
+        stats.serializeTime += time.time() - built
+        # Nodes are released straight away when streaming
+        stats.nodes = 0
+    out.flush()
+
+
+class KMLStats:
+    """ KMLStats class.
+    
+    Collects counts and timings of building and writing a document. Created by KMLDocument and KMLStreamWriter when
+    instrumentation is enabled.
+    
+    """
+    
+    def __init__(self, callback=None):
+        """ Init KMLStats
+        
+        Arguments:
+        callback - a function called with the stats dictionary every time a document has been written
+        
+        """
+        self.callback = callback
+        self.counts = {}
+        self.buildTime = 0.0
+        self.serializeTime = 0.0
+        self.bytes = 0
+        self.nodes = 0
+        self.peakNodes = 0
+        self.timings = {}
+        self.vertices = {}
+        
+    def addElement(self, element, node, seconds):
+        """ Record an element added to the document with its DOM node and the time it took to build and add it """
+        name = element.__class__.__name__
+        count = 1
+        if isinstance(element, PointBatch):
+            # Points of a batch are counted the same way as points added one by one
+            name, count = 'Point', len(element)
+        self.counts[name] = self.counts.get(name, 0) + count
+        self.buildTime += seconds
+        if node is not None:
+            self.nodes += _countNodes(node)
+            self.peakNodes = max(self.peakNodes, self.nodes)
+        vertexCounts = getattr(element, 'vertexCounts', None)
+        if vertexCounts is not None:
+            before, after = self.vertices.get(name, (0, 0))
+            self.vertices[name] = (before + vertexCounts[0], after + vertexCounts[1])
+        
+    def addWrite(self, seconds, size):
+        """ Record a finished write and call the callback """
+        self.serializeTime += seconds
+        if size is not None:
+            self.bytes += size
+        if self.callback is not None:
+            self.callback(self.stats())
+            
+    def timed(self, name, function):
+        """ Return a wrapper of function recording number of calls and time spent in it under the given name.
+        
+        Example:
+        parseDate = kmldoc.statistics.timed('parseDate', kml.parseDate)
+        
+        """
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                calls, seconds = self.timings.get(name, (0, 0.0))
+                self.timings[name] = (calls + 1, seconds + time.time() - start)
+        return wrapper
+    
+    def stats(self):
+        """ Return collected statistics as a dictionary """
+        return {
+            'counts': dict(self.counts),
+            'buildTime': self.buildTime,
+            'serializeTime': self.serializeTime,
+            'bytes': self.bytes,
+            'nodes': self.nodes,
+            'peakNodes': self.peakNodes,
+            'timings': dict((name, {'calls': calls, 'seconds': seconds}) for name, (calls, seconds) in self.timings.items()),
+            'vertices': dict((name, {'before': before, 'after': after}) for name, (before, after) in self.vertices.items()),
+        }
+
+def _countNodes(node):
+    """ Return number of nodes in a DOM subtree """
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.childNodes)
+    return count
+
+
+class StyleRegistry:
+    """ StyleRegistry class.
+    
+    Collapses Style and StyleMap objects with the same content to the id of the first one added, and rewrites
+    styleUrl references to the ids of collapsed styles. Used by KMLDocument and KMLStreamWriter with
+    dedupeStyles=True.
+    
+    References are only rewritten in elements added after a style is collapsed, so a style whose id has already
+    been referenced is always kept.
+    
+    """
+    
+    def __init__(self):
+        # Content key -> id of the style written for it
+        self.ids = {}
+        # Id of a collapsed style -> id of the style it was collapsed to
+        self.aliases = {}
+        # Style ids referenced by elements added so far
+        self.referenced = set()
+        
+    def process(self, element):
+        """ Register styles and resolve style references of other elements.
+        
+        Return the element to write, a copy if its references had to be changed, or None if it's a style with the
+        same content as one added before.
+        
+        """
+        element = self.prepare(element)
+        if not isinstance(element, (Style, StyleMap)):
+            return element
+        key = element.key()
+        styleId = self.ids.get(key)
+        if styleId is None:
+            self.ids[key] = element.id
+            self.aliases.pop(element.id, None)
+            return element
+        if styleId == element.id:
+            return None
+        if element.id in self.referenced:
+            # Elements added before refer to it by its own id
+            return element
+        self.aliases[element.id] = styleId
+        return None
+        
+    def resolve(self, styleId):
+        """ Return id of the style written for a style id """
+        return self.aliases.get(styleId, styleId)
+    
+    def resolveUrl(self, url):
+        """ Return a styleUrl with the id of a collapsed style replaced, and remember the id as referenced """
+        url = str(url)
+        if url.startswith('#'):
+            styleId = self.aliases.get(url[1:], url[1:])
+            self.referenced.add(styleId)
+            return '#' + styleId
+        return url
+        
+    def prepare(self, element):
+        """ Return a copy of a StyleMap or PointBatch referencing collapsed styles, or the element itself.
+        
+        References in other elements are rewritten in their DOM nodes by rewrite.
+        
+        """
+        if isinstance(element, PointBatch) and element.styles is not None:
+            if isinstance(element.styles, basestring):
+                self.referenced.add(self.resolve(element.styles))
+            else:
+                self.referenced.update(self.resolve(style) for style in set(_toList(element.styles)) if style)
+        if not self.aliases:
+            if isinstance(element, StyleMap):
+                for url in element.styles.values():
+                    self.resolveUrl(url)
+            return element
+        if isinstance(element, StyleMap):
+            styles = dict((k, self.resolveUrl(v)) for k, v in element.styles.items())
+            if styles != dict((k, str(v)) for k, v in element.styles.items()):
+                return StyleMap(element.id, styles)
+        elif isinstance(element, PointBatch) and element.styles is not None:
+            if isinstance(element.styles, basestring):
+                styles = self.resolve(element.styles)
+                changed = styles != element.styles
+            else:
+                styles = _toList(element.styles)
+                changed = any(style in self.aliases for style in styles)
+                styles = [self.resolve(style) if style else style for style in styles]
+            if changed:
+                return PointBatch(element.lats, element.lons, element.names, element.descriptions, element.dts, styles,
+                                  element.data, element.schema, element.dataFields, element.precision)
+        return element
+        
+    def rewrite(self, node):
+        """ Rewrite styleUrl elements of a DOM node referencing collapsed styles """
+        for styleUrl in node.getElementsByTagName('styleUrl'):
+            for text in styleUrl.childNodes:
+                if text.nodeType == TEXT_NODE:
+                    text.data = self.resolveUrl(text.data)
+
+
+class SpatialIndex:
+    """ SpatialIndex class.
+    
+    A uniform grid of bounding boxes of placemarks and overlays, updated as elements are added. Used by KMLDocument
+    for bounding box queries, nearest element lookups and the document extent without going through the DOM.
+    
+    Every element is stored in the grid cells its box covers, so a query only checks elements of the cells it
+    covers. Boxes covering more than maxCells cells are checked by every query. Points of a PointBatch are indexed
+    one by one (with numpy if available) and returned as Point objects.
+    
+    """
+    
+    # Elements covering more cells are kept in a single list instead of the grid
+    maxCells = 64
+    
+    def __init__(self, cellSize=0.01):
+        """ Init SpatialIndex
+        
+        Arguments:
+        cellSize - size of a grid cell in degrees, about the size of a typical query works best
+        
+        """
+        self.cellSize = float(cellSize)
+        # (row, column) -> ids of elements in the cell, and ids of elements covering too many cells
+        self.cells = {}
+        self.large = array.array('l')
+        # Element (or PointBatch) of every id, index of the point in the batch (-1 for other elements) and boxes as
+        # south, west, north, east
+        self.elements = []
+        self.offsets = array.array('l')
+        self.boxes = array.array('d')
+        self.extent = None
+        
+    def __len__(self):
+        return len(self.elements)
+        
+    def add(self, element):
+        """ Index an element. Elements without coordinates (styles, folders...) are ignored. """
+        if isinstance(element, PointBatch):
+            self.addBatch(element)
+            return
+        if type(element) is Point:
+            self.addPoint(element)
+            return
+        bounds = _elementBounds(element)
+        if bounds is None:
+            return
+        itemId = len(self.elements)
+        self.elements.append(element)
+        self.offsets.append(-1)
+        self.boxes.extend(bounds)
+        self.extend(bounds)
+        south, west, north, east = bounds
+        rows = xrange(self.cell(south), self.cell(north) + 1)
+        columns = xrange(self.cell(west), self.cell(east) + 1)
+        if len(rows) * len(columns) > self.maxCells:
+            self.large.append(itemId)
+            return
+        for row in rows:
+            for column in columns:
+                cell = self.cells.get((row, column))
+                if cell is None:
+                    cell = self.cells[(row, column)] = array.array('l')
+                cell.append(itemId)
+                
+    def addPoint(self, point):
+        """ Index a single Point, the same as add but faster """
+        lat = float(point.lat)
+        lon = float(point.lon)
+        itemId = len(self.elements)
+        self.elements.append(point)
+        self.offsets.append(-1)
+        self.boxes.extend((lat, lon, lat, lon))
+        extent = self.extent
+        if extent is None or not (extent[0] <= lat <= extent[2] and extent[1] <= lon <= extent[3]):
+            self.extend((lat, lon, lat, lon))
+        key = (int(math.floor(lat / self.cellSize)), int(math.floor(lon / self.cellSize)))
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = array.array('l')
+        cell.append(itemId)
+        
+    def addBatch(self, batch):
+        """ Index all points of a PointBatch """
+        n = len(batch)
+        if n == 0:
+            return
+        first = len(self.elements)
+        self.elements.extend([batch] * n)
+        self.offsets.extend(xrange(n))
+        if numpy is None:
+            lats = [float(lat) for lat in _toList(batch.lats)]
+            lons = [float(lon) for lon in _toList(batch.lons)]
+            for i, (lat, lon) in enumerate(itertools.izip(lats, lons)):
+                self.boxes.extend((lat, lon, lat, lon))
+                key = (self.cell(lat), self.cell(lon))
+                cell = self.cells.get(key)
+                if cell is None:
+                    cell = self.cells[key] = array.array('l')
+                cell.append(first + i)
+            self.extend((min(lats), min(lons), max(lats), max(lons)))
+            return
+        lats = numpy.asarray(batch.lats, dtype=float)
+        lons = numpy.asarray(batch.lons, dtype=float)
+        self.boxes.fromstring(numpy.column_stack((lats, lons, lats, lons)).tostring())
+        self.extend((lats.min(), lons.min(), lats.max(), lons.max()))
+        # Points are sorted by cell, so every cell is extended once
+        rows = numpy.floor(lats / self.cellSize).astype(numpy.int_)
+        columns = numpy.floor(lons / self.cellSize).astype(numpy.int_)
+        codes = (rows - rows.min()) * (columns.max() - columns.min() + 1) + (columns - columns.min())
+        order = numpy.argsort(codes, kind='mergesort')
+        starts = numpy.flatnonzero(numpy.diff(codes[order])) + 1
+        ids = (order + first).astype(numpy.int_)
+        for start, end in zip(numpy.r_[0, starts].tolist(), numpy.r_[starts, n].tolist()):
+            key = (int(rows[order[start]]), int(columns[order[start]]))
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = self.cells[key] = array.array('l')
+            cell.fromstring(ids[start:end].tostring())
+            
+    def cell(self, value):
+        """ Return grid row or column of a latitude or longitude """
+        return int(math.floor(value / self.cellSize))
+    
+    def extend(self, bounds):
+        """ Extend the extent of the index by a box """
+        if self.extent is None:
+            self.extent = tuple(float(value) for value in bounds)
+        else:
+            south, west, north, east = self.extent
+            self.extent = (min(south, bounds[0]), min(west, bounds[1]), max(north, bounds[2]), max(east, bounds[3]))
+        
+    def bounds(self):
+        """ Return (south, west, north, east) box of all indexed elements, or None if there are none """
+        return self.extent
+    
+    def element(self, itemId):
+        """ Return the element with the given id, a Point for points of a PointBatch """
+        offset = self.offsets[itemId]
+        if offset < 0:
+            return self.elements[itemId]
+        return self.elements[itemId].point(offset)
+        
+    def query(self, bbox):
+        """ Return elements intersecting a (south, west, north, east) box in the order they were added """
+        south, west, north, east = bbox
+        rows = xrange(self.cell(south), self.cell(north) + 1)
+        columns = xrange(self.cell(west), self.cell(east) + 1)
+        found = set(self.large)
+        if len(rows) * len(columns) <= len(self.cells):
+            for row in rows:
+                for column in columns:
+                    found.update(self.cells.get((row, column), ()))
+        else:
+            # Fewer occupied cells than cells in the box
+            for (row, column), cell in self.cells.iteritems():
+                if row in rows and column in columns:
+                    found.update(cell)
+        boxes = self.boxes
+        return [self.element(itemId) for itemId in sorted(found)
+                if boxes[4 * itemId] <= north and boxes[4 * itemId + 2] >= south and
+                boxes[4 * itemId + 1] <= east and boxes[4 * itemId + 3] >= west]
+    
+    def nearest(self, latitude, longitude, count=1):
+        """ Return up to count elements nearest to a point, nearest first.
+        
+        Distances are measured to element boxes, with longitudes scaled by the cosine of the latitude.
+        
+        """
+        if not self.elements or count < 1:
+            return []
+        scale = math.cos(math.radians(latitude))
+        boxes = self.boxes
+        
+        def distance(itemId):
+            box = boxes[4 * itemId:4 * itemId + 4]
+            dlat = max(box[0] - latitude, 0.0, latitude - box[2])
+            dlon = max(box[1] - longitude, 0.0, longitude - box[3]) * scale
+            return dlat * dlat + dlon * dlon
+        
+        best = []
+        # Elements covering several cells are found in each of them
+        seen = set()
+        def consider(ids):
+            for itemId in ids:
+                if itemId in seen:
+                    continue
+                seen.add(itemId)
+                item = (distance(itemId), itemId)
+                if len(best) < count:
+                    heapq.heappush(best, (-item[0], -item[1]))
+                elif item[0] < -best[0][0]:
+                    heapq.heapreplace(best, (-item[0], -item[1]))
+                    
+        consider(self.large)
+        row, column = self.cell(latitude), self.cell(longitude)
+        south, west, north, east = self.extent
+        # Rings of cells around the cell of the point until no closer element can be found
+        reach = max(row - self.cell(south), self.cell(north) - row, column - self.cell(west), self.cell(east) - column)
+        visited = 0
+        for ring in xrange(reach + 1):
+            if ring == 0:
+                keys = [(row, column)]
+            else:
+                keys = [(row + i, column + j) for i in (-ring, ring) for j in xrange(-ring, ring + 1)]
+                keys.extend((row + i, column + j) for j in (-ring, ring) for i in xrange(-ring + 1, ring))
+            for key in keys:
+                consider(self.cells.get(key, ()))
+            visited += len(keys)
+            limit = ring * self.cellSize * scale
+            if len(best) == count and -best[0][0] <= limit * limit:
+                break
+            if visited > len(self.cells):
+                # Empty cells would take longer than checking all occupied ones
+                for key, cell in self.cells.iteritems():
+                    if max(abs(key[0] - row), abs(key[1] - column)) > ring:
+                        consider(cell)
+                break
+        return [self.element(-itemId) for distance, itemId in sorted(best, reverse=True)]
+
+
+class KMLDocument:
+    """ KML document class """
+    
+    def __init__(self, title, description="", instrument=False, callback=None, dedupeStyles=False, spatialIndex=False, precision=None):
+        """ Init KMLDocument
+        
+        Arguments:
+        title - document title
+        description - document description
+        instrument - whether counts and timings should be collected, see stats()
+        callback - a function called with the stats dictionary every time the document has been written, enables
+                   instrumentation
+        dedupeStyles - whether styles with the same content as a style added before should be left out, with
+                       references to them pointing to the earlier style, see StyleRegistry
+        spatialIndex - whether boxes of added elements should be indexed for query, nearest, bounds and updateView,
+                       see SpatialIndex
+        precision - number of decimals of coordinates of added elements that don't set their own precision, see
+                    formatCoordinates
+        
+        """       
+        self.title = title
+        self.description = description
+        self.document = self.kml()
+        self.documentNode = self.document.documentElement.getElementsByTagName('Document')[0]
+        self.folders = []
+        self.folderNodes = {}
+        self.styleRegistry = StyleRegistry() if dedupeStyles else None
+        self.styleCache = StyleCache()
+        self.precision = precision
+        self.index = SpatialIndex() if spatialIndex else None
+        self.statistics = None
+        if instrument or callback is not None:
+            self.statistics = KMLStats(callback)
+            self.statistics.nodes = self.statistics.peakNodes = _countNodes(self.document.documentElement)
+            # Writer functions find the stats through the DOM document
+            self.document.stats = self.statistics
+        
+    def stats(self):
+        """ Return a dictionary of element counts, build and serialize times, bytes written and peak DOM node count.
+        
+        Returns an empty dictionary if instrumentation is disabled.
+        
+        """
+        if self.statistics is None:
+            return {}
+        return self.statistics.stats()
+        
+    def kml(self):
+        """ Creates KML document and returns DOM document """
+        doc = Document()
+        
+        # <kml>
+        kml = doc.createElement('kml')
+        kml.setAttribute('xmlns', 'http://www.opengis.net/kml/2.2')
+        doc.appendChild(kml)
+        
+        # <document>
+        document = doc.createElement('Document')
+        kml.appendChild(document)
+        
+        # <name>
+        docName = doc.createElement('name')
+        document.appendChild(docName)    
+        docNameText = doc.createTextNode(self.title)
+        docName.appendChild(docNameText)
+        
+        # <description>
+        docDesc = doc.createElement('description')    
+        document.appendChild(docDesc)    
+        docDescText = doc.createTextNode(self.description)
+        docDesc.appendChild(docDescText)
+        
+        return doc
+    
+    def addElement(self, element):
+        """ Add an element to the document 
+        
+        Arguments:
+        element - xml.dom.minidom.Document object to be added
+        
+        """
+        self.appendElement(self.documentNode, element)
+        
+    def addElements(self, *elements):
+        """ Convenience method for adding multiple elements """
+        for element in elements:
+            self.addElement(element)
+        
+    def addFolder(self, folder):
+        """ Add folder to the document """
+        self.addElement(folder)
+        
+    def addElementToFolder(self, element, folderName):
+        """ Add element to the folder 
+        
+        The folder needs to be created earlier and added to the KMLDocument. Folders can be nested by adding a
+        Folder to another folder.
+       
+        """        
+        if folderName in self.folderNodes:
+            self.appendElement(self.folderNodes[folderName], element)
+        else:
+            print "No folder named %s. Please create it first." % folderName
+
+    def addPoints(self, latitudes, longitudes, folderName=None, **kwargs):
+        """ Add many points at once as a PointBatch
+        
+        Arguments:
+        latitudes - a sequence of geographical latitudes
+        longitudes - a sequence of geographical longitudes
+        folderName - a name of the folder to add points to, points are added to the document if not given
+        
+        Other keyword arguments are passed to PointBatch.
+        
+        """
+        batch = PointBatch(latitudes, longitudes, **kwargs)
+        if folderName is None:
+            self.addElement(batch)
+        else:
+            self.addElementToFolder(batch, folderName)
+        return batch
+
+    def appendElement(self, parent, element):
+        """ Append element node to the parent node and index it if it's a folder.
+        
+        Return the node, or None if the element is a style collapsed to an earlier one.
+        
+        """
+        # The clock is only read when statistics are collected
+        start = time.time() if self.statistics is not None else None
+        if self.styleRegistry is not None:
+            element = self.styleRegistry.process(element)
+            if element is None:
+                return None
+        node = _elementNode(element, self.precision)
+        if isinstance(element, (Style, StyleMap)):
+            node = StyleFragment(element, node, self.styleCache)
+        elif self.styleRegistry is not None:
+            self.styleRegistry.rewrite(node)
+        parent.appendChild(node)
+        if self.index is not None:
+            self.index.add(element)
+        if self.statistics is not None:
+            self.statistics.addElement(element, node, time.time() - start)
+        if isinstance(element, Folder) and element.name not in self.folderNodes:
+            # Keep the first folder with a given name, like a document order search would
+            self.folderNodes[element.name] = node
+            self.folders.append(element.name)
+        return node
+    
+    def spatialIndex(self):
+        """ Return the SpatialIndex of the document. Raises ValueError if it was created with spatialIndex=False. """
+        if self.index is None:
+            raise ValueError("Spatial index is disabled, create the document with spatialIndex=True")
+        return self.index
+    
+    def query(self, bbox):
+        """ Return elements intersecting a (south, west, north, east) box, see SpatialIndex.query """
+        return self.spatialIndex().query(bbox)
+    
+    def nearest(self, latitude, longitude, count=1):
+        """ Return up to count elements nearest to a point, see SpatialIndex.nearest """
+        return self.spatialIndex().nearest(latitude, longitude, count)
+    
+    def bounds(self):
+        """ Return (south, west, north, east) box of all elements with coordinates, or None if there are none """
+        return self.spatialIndex().bounds()
+    
+    def updateView(self, lookAt=True, region=False, minLodPixels=128, maxLodPixels=-1):
+        """ Set the LookAt and Region of the document to the box of all elements added so far.
+        
+        Arguments:
+        lookAt - whether a LookAt showing all elements should be set
+        region - whether a Region should be set, so the document is only shown when its box is big enough
+        minLodPixels - minimum size of the region on the screen in pixels
+        maxLodPixels - maximum size of the region on the screen in pixels, -1 for no limit
+        
+        LookAt and Region set before are replaced. Nothing is set if there are no elements with coordinates.
+        
+        """
+        bounds = self.bounds()
+        description = None
+        # Only the header of the document is searched, LookAt and Region are set right after the description
+        for node in list(self.documentNode.childNodes[:4]):
+            if node.tagName in ('LookAt', 'Region'):
+                self.documentNode.removeChild(node)
+            elif node.tagName == 'description':
+                description = node
+        if bounds is None:
+            return
+        south, west, north, east = bounds
+        nodes = []
+        if lookAt:
+            nodes.append(lookAtBounds(south, west, north, east).kml().documentElement)
+        if region:
+            nodes.append(Region(north, south, east, west, minLodPixels, maxLodPixels).kml().documentElement)
+        # After <name> and <description>
+        for node in reversed(nodes):
+            self.documentNode.insertBefore(node, description.nextSibling)
+
+
+class LazyKMLDocument:
+    """ Lazy KML document class.
+    
+    Keeps element objects (Style, Folder, Point, Path...) in an ordered tree and creates KML only when the document
+    is written. Elements can be removed, replaced and moved between folders cheaply, which makes it a better fit
+    than KMLDocument for documents edited many times before they are saved.
+    
+    Example:
+    kmldoc = kml.LazyKMLDocument("My KML document")
+    kmldoc.addFolder(kml.Folder("Points"))
+    kmldoc.addElementToFolder(point, "Points")
+    kmldoc.moveToFolder(point, "Selected")
+    kmldoc.write("example.kml")
+    
+    """
+    
+    def __init__(self, title, description="", precision=None):
+        """ Init LazyKMLDocument
+        
+        Arguments:
+        title - document title
+        description - document description
+        precision - number of decimals of coordinates of elements that don't set their own precision, see
+                    formatCoordinates
+        
+        """
+        self.title = title
+        self.description = description
+        self.precision = precision
+        # Ordered children of the document (None) and of every folder, keyed by insertion number
+        self.children = {None: collections.OrderedDict()}
+        # id(element) -> (parent folder or None, key in parent's children)
+        self.locations = {}
+        self.folderObjects = {}
+        self.keys = itertools.count()
+        
+    def addElement(self, element):
+        """ Add an element to the document """
+        self.insert(None, element)
+        
+    def addElements(self, *elements):
+        """ Convenience method for adding multiple elements """
+        for element in elements:
+            self.addElement(element)
+            
+    def addFolder(self, folder):
+        """ Add folder to the document """
+        self.addElement(folder)
+        
+    def addElementToFolder(self, element, folderName):
+        """ Add element to the folder 
+        
+        The folder needs to be created earlier and added to the document.
+        
+        """
+        if folderName in self.folderObjects:
+            self.insert(self.folderObjects[folderName], element)
+        else:
+            print "No folder named %s. Please create it first." % folderName
+            
+    def addPoints(self, latitudes, longitudes, folderName=None, **kwargs):
+        """ Add many points at once as a PointBatch, see KMLDocument.addPoints """
+        batch = PointBatch(latitudes, longitudes, **kwargs)
+        if folderName is None:
+            self.addElement(batch)
+        else:
+            self.addElementToFolder(batch, folderName)
+        return batch
+    
+    def insert(self, parent, element):
+        """ Append element to the children of parent folder (None for the document) """
+        if id(element) in self.locations:
+            raise ValueError("Element is already in the document")
+        key = self.keys.next()
+        self.children[parent][key] = element
+        self.locations[id(element)] = (parent, key)
+        if isinstance(element, Folder):
+            self.children[element] = collections.OrderedDict()
+            if element.name not in self.folderObjects:
+                self.folderObjects[element.name] = element
+                
+    def parent(self, element):
+        """ Return folder containing the element, or None if it's added to the document """
+        return self.locations[id(element)][0]
+                
+    def remove(self, element):
+        """ Remove an element from the document. Removing a folder removes its contents too. """
+        parent, key = self.locations[id(element)]
+        del self.children[parent][key]
+        self.forget(element)
+        
+    def forget(self, element):
+        """ Drop locations of an element and of all folder contents """
+        del self.locations[id(element)]
+        if isinstance(element, Folder):
+            for child in self.children.pop(element).values():
+                self.forget(child)
+            if self.folderObjects.get(element.name) is element:
+                self.refreshFolder(element.name)
+                
+    def refreshFolder(self, name):
+        """ Point a folder name to the first added folder with the name left in the document, or drop it """
+        folders = [folder for folder in self.children if folder is not None and folder.name == name]
+        if folders:
+            # Keys of elements are increasing insertion numbers
+            self.folderObjects[name] = min(folders, key=lambda folder: self.locations[id(folder)][1])
+        else:
+            self.folderObjects.pop(name, None)
+            
+    def replace(self, element, newElement):
+        """ Replace an element with another one, keeping its position. A replaced folder keeps its contents if it's
+        replaced with another folder.
+        
+        """
+        if id(newElement) in self.locations:
+            raise ValueError("Element is already in the document")
+        parent, key = self.locations[id(element)]
+        contents = None
+        if isinstance(element, Folder) and isinstance(newElement, Folder):
+            contents = self.children[element]
+            self.children[element] = collections.OrderedDict()
+        self.remove(element)
+        self.children[parent][key] = newElement
+        self.locations[id(newElement)] = (parent, key)
+        if isinstance(newElement, Folder):
+            self.children[newElement] = contents if contents is not None else collections.OrderedDict()
+            for childKey, child in self.children[newElement].items():
+                self.locations[id(child)] = (newElement, childKey)
+            # The new folder takes the place of the old one, also as the first added folder with its name
+            self.refreshFolder(newElement.name)
+                
+    def moveToFolder(self, element, folderName):
+        """ Move an element to the end of the folder. Use None as folderName to move it to the document. """
+        if folderName is None:
+            folder = None
+        elif folderName in self.folderObjects:
+            folder = self.folderObjects[folderName]
+        else:
+            print "No folder named %s. Please create it first." % folderName
+            return
+        # A folder can't be moved into itself or into one of its subfolders
+        ancestor = folder
+        while ancestor is not None:
+            if ancestor is element:
+                raise ValueError("Can't move folder %s into itself" % element.name)
+            ancestor = self.parent(ancestor)
+        parent, key = self.locations[id(element)]
+        del self.children[parent][key]
+        key = self.keys.next()
+        self.children[folder][key] = element
+        self.locations[id(element)] = (folder, key)
+        
+    def iterElements(self, parent=None):
+        """ Return a generator of all elements in document order, every folder followed by its contents """
+        for element in self.children[parent].values():
+            yield element
+            if isinstance(element, Folder):
+                for child in self.iterElements(element):
+                    yield child
+            
+    def kml(self):
+        """ Create a KMLDocument with all elements and return its DOM document """
+        kmldoc = KMLDocument(self.title, self.description, precision=self.precision)
+        self.appendChildren(kmldoc, kmldoc.documentNode, None)
+        return kmldoc.document
+    
+    def appendChildren(self, kmldoc, parentNode, parent):
+        """ Append DOM nodes of the children of parent folder to parentNode """
+        for element in self.children[parent].values():
+            node = kmldoc.appendElement(parentNode, element)
+            if isinstance(element, Folder):
+                self.appendChildren(kmldoc, node, element)
+    
+    @property
+    def document(self):
+        """ DOM document with all elements, created on access. Can be used with writeKML and printKML. """
+        return self.kml()
+    
+    def write(self, fileOut, compact=False):
+        """ Write the document to a file with KMLStreamWriter, without creating the full DOM tree
+        
+        Arguments:
+        fileOut - kml output filename or a file object opened for writing
+        compact - whether the document should be written without indentation and newlines
+        
+        """
+        with KMLStreamWriter(fileOut, self.title, self.description, compact=compact, precision=self.precision) as out:
+            self.writeChildren(out, None)
+            
+    def writeChildren(self, out, parent):
+        """ Write the children of parent folder to a KMLStreamWriter """
+        for element in self.children[parent].values():
+            if isinstance(element, Folder):
+                with out.folder(element.name, element.region):
+                    self.writeChildren(out, element)
+            else:
+                out.addElement(element)
+
+
+class KMLStreamWriter:
+    """ Streaming KML writer.
+
+    Writes the document header straight away and then serializes every element to the output as soon as it is
+    added, so the full DOM tree never has to be kept in memory. The output is the same as the one produced by
+    writeKML for a KMLDocument built from the same elements in the same order.
+
+    Example:
+    with kml.KMLStreamWriter("example.kml", "My KML document") as out:
+        out.addElements(trackStyle, pointStyle, track)
+        with out.folder("Points"):
+            for latitude, longitude, date in data:
+                out.addElement(kml.Point(latitude, longitude, datetime=kml.parseDate(date), style="pointStyle"))
+
+    """
+
+    def __init__(self, fileOut, title, description="", instrument=False, callback=None, header=True, dedupeStyles=False, styleRegistry=None, compact=False, styleCache=None, precision=None):
+        """ Init KMLStreamWriter and write the document header
+
+        Arguments:
+        fileOut - kml output filename or a file object opened for writing
+        title - document title
+        description - document description
+        instrument - whether counts and timings should be collected, see stats()
+        callback - a function called with the stats dictionary when the writer is closed, enables instrumentation
+        header - whether the document header should be written. Use False to continue a file left by detach(), a
+                 file given by name is then opened for appending.
+        dedupeStyles - whether styles with the same content as a style written before should be left out, with
+                       references to them pointing to the earlier style, see StyleRegistry
+        styleRegistry - StyleRegistry to use instead of a new one, e.g. the one of a detached writer of the same file
+        compact - whether the document should be written without indentation and newlines
+        styleCache - StyleCache to use instead of a new one, e.g. one shared by files with the same styles
+        precision - number of decimals of coordinates of elements that don't set their own precision, see
+                    formatCoordinates
+
+        """
+        if isinstance(fileOut, basestring):
+            self.fileOut = open(fileOut, "w" if header else "a")
+            self.ownsFile = True
+        else:
+            self.fileOut = fileOut
+            self.ownsFile = False
+        self.writer = codecs.getwriter('UTF-8')(self.fileOut)
+        self.title = title
+        self.description = description
+        self.indent, self.newl = _whitespace(compact)
+        self.folders = []
+        self.closed = False
+        self.styleRegistry = styleRegistry
+        if styleRegistry is None and dedupeStyles:
+            self.styleRegistry = StyleRegistry()
+        self.styleCache = styleCache if styleCache is not None else StyleCache()
+        self.precision = precision
+        self.statistics = None
+        if instrument or callback is not None:
+            self.statistics = KMLStats(callback)
+        self.start = time.time()
+        if header:
+            self.writeHeader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        elif self.ownsFile:
+            self.fileOut.close()
+
+    def depth(self):
+        """ Return nesting depth of the elements written next """
+        return len(self.folders) + 2
+
+    def writeHeader(self):
+        """ Write xml declaration and opening <kml> and <Document> tags """
+        self.writer.write('<?xml version="1.0" encoding="UTF-8"?>' + self.newl)
+        self.writer.write('<kml xmlns="http://www.opengis.net/kml/2.2">' + self.newl)
+        self.writer.write(self.indent + '<Document>' + self.newl)
+        _writeText(self.writer, 'name', self.title, self.indent * 2, self.newl)
+        _writeText(self.writer, 'description', self.description, self.indent * 2, self.newl)
+
+    def addElement(self, element):
+        """ Serialize an element to the output
+
+        Arguments:
+        element - Style, StyleMap, Folder, Point, Path, Polygon or GroundOverlay object
+
+        Elements are added to the folder opened last with beginFolder, or to the document if there isn't one.
+
+        """
+        if self.styleRegistry is not None:
+            element = self.styleRegistry.process(element)
+            if element is None:
+                return
+        _writeElement(self.writer, element, self.depth(), self.statistics, self.styleRegistry, self.indent, self.newl,
+                      self.styleCache, self.precision)
+
+    def addElements(self, *elements):
+        """ Convenience method for adding multiple elements """
+        for element in elements:
+            self.addElement(element)
+
+    def beginFolder(self, name, region=None):
+        """ Open a folder, with a Region if given. Elements added until the matching endFolder call are written inside it. """
+        indent = self.indent * self.depth()
+        self.writer.write(indent + '<Folder>' + self.newl)
+        _writeText(self.writer, 'name', name, indent + self.indent, self.newl)
+        if region is not None:
+            _writeElement(self.writer, region, self.depth() + 1, addindent=self.indent, newl=self.newl)
+        self.folders.append(name)
+
+    def endFolder(self):
+        """ Close the folder opened last """
+        self.folders.pop()
+        self.writer.write(self.indent * self.depth() + '</Folder>' + self.newl)
+
+    @contextlib.contextmanager
+    def folder(self, name, region=None):
+        """ Context manager wrapping beginFolder and endFolder """
+        self.beginFolder(name, region)
+        yield self
+        self.endFolder()
+
+    def close(self):
+        """ Close any open folders, write closing tags and close the file if it was opened by the writer """
+        if self.closed:
+            return
+        while self.folders:
+            self.endFolder()
+        self.writeTrailer()
+        if self.statistics is not None:
+            self.fileOut.flush()
+            try:
+                size = self.fileOut.tell()
+            except IOError:
+                # Not seekable, e.g. a pipe
+                size = None
+            # Element serialization time has already been added
+            elapsed = time.time() - self.start - self.statistics.buildTime - self.statistics.serializeTime
+            self.statistics.addWrite(elapsed, size)
+        if self.ownsFile:
+            self.fileOut.close()
+        else:
+            self.fileOut.flush()
+        self.closed = True
+        
+    def writeTrailer(self):
+        """ Write closing </Document> and </kml> tags """
+        self.writer.write(self.indent + '</Document>' + self.newl)
+        self.writer.write('</kml>' + self.newl)
+        
+    def detach(self):
+        """ Close the file without closing open folders and writing closing tags.
+        
+        Writing can be continued later with a new KMLStreamWriter created with header=False.
+        
+        """
+        if self.ownsFile:
+            self.fileOut.close()
+        else:
+            self.fileOut.flush()
+        self.closed = True
+        
+    def stats(self):
+        """ Return a dictionary of element counts, build and serialize times and bytes written.
+        
+        Returns an empty dictionary if instrumentation is disabled.
+        
+        """
+        if self.statistics is None:
+            return {}
+        return self.statistics.stats()
+
+
+class KMLAppendWriter(KMLStreamWriter):
+    """ Appending KML writer.
+    
+    Adds elements to an existing KML file written by this module (with writeKML, KMLStreamWriter...), before the
+    closing </Document> tag or before the closing tag of a named folder. Only the end of the file is read and
+    rewritten, so the cost of appending to the document depends on the size of the new elements and not on the
+    size of the file. Appending to a folder reads the file back to the name of the folder.
+    
+    The file is changed in place. Its closing tags are saved to a journal file (the file name with .journal added)
+    before they are cut off and the journal is removed once they are written back. If the writer is interrupted,
+    e.g. by a crash, the next KMLAppendWriter opening the file (or recoverAppend) restores the file from the
+    journal, without the elements of the interrupted append.
+    
+    Example:
+    with kml.KMLAppendWriter("example.kml", folderName="Points") as out:
+        for latitude, longitude, date in newData:
+            out.addElement(kml.Point(latitude, longitude, datetime=kml.parseDate(date), style="pointStyle"))
+    
+    """
+    
+    def __init__(self, filename, folderName=None, instrument=False, callback=None, dedupeStyles=False, precision=None):
+        """ Init KMLAppendWriter and cut the closing tags off the file
         
-        attrs = self._get_attributes()
-        a_names = attrs.keys()
-        a_names.sort()
+        Arguments:
+        filename - path of an existing kml file
+        folderName - name of the folder to add elements to, elements are added to the document if not given. The
+                     last folder with the name is used. The file is read from the start of the folder and
+                     everything after its end is written again, so appending is cheapest to small folders at the
+                     end of the file.
+        instrument - whether counts and timings should be collected, see stats()
+        callback - a function called with the stats dictionary when the writer is closed, enables instrumentation
+        dedupeStyles - whether styles with the same content as a style added with this writer should be left out,
+                       styles already in the file aren't known
+        precision - number of decimals of coordinates of elements that don't set their own precision, see
+                    formatCoordinates
         
-        for a_name in a_names:
-            writer.write(" %s=\"" %a_name)
-            xdm._write_data(writer, attrs[a_name].value)
-            writer.write("\"")
+        """
+        recoverAppend(filename)
+        fileOut = open(filename, "r+b")
+        try:
+            self.position, self.tail, self.baseDepth = _findTrailer(fileOut, folderName)
+        except:
+            fileOut.close()
+            raise
+        self.journal = filename + ".journal"
+        _writeJournal(self.journal, self.position, self.tail)
+        fileOut.seek(self.position)
+        fileOut.truncate()
+        # Files written without newlines are continued the same way
+        KMLStreamWriter.__init__(self, fileOut, None, instrument=instrument, callback=callback, header=False,
+                                 dedupeStyles=dedupeStyles, compact="\n" not in self.tail, precision=precision)
+        self.ownsFile = True
         
-        if self.childNodes:
-            newl2 = newl
-            if len(self.childNodes) == 1 and self.childNodes[0].nodeType == xdm.Node.TEXT_NODE:
-                indent, addindent, newl = "", "", ""            
-            writer.write(">%s" %(newl))
-            
-            for node in self.childNodes:
-                node.writexml(writer, indent+addindent, addindent, newl)                            
-            writer.write("%s</%s>%s" %(indent, self.tagName, newl2))            
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
         else:
-            writer.write("/>%s" %(newl))
+            self.abort()
+            
+    def depth(self):
+        """ Return nesting depth of the elements written next """
+        return len(self.folders) + self.baseDepth
+        
+    def writeTrailer(self):
+        """ Write back the closing tags cut off the file """
+        # New elements are on disk before the closing tags, so a file ending with them is always complete
+        _sync(self.fileOut)
+        self.fileOut.write(self.tail)
+        _sync(self.fileOut)
+        
+    def close(self):
+        """ Close any open folders, write back the closing tags, close the file and remove the journal """
+        if self.closed:
+            return
+        KMLStreamWriter.close(self)
+        os.remove(self.journal)
+        
+    def abort(self):
+        """ Restore the file without the elements added by the writer """
+        if self.closed:
+            return
+        self.fileOut.seek(self.position)
+        self.fileOut.truncate()
+        self.fileOut.write(self.tail)
+        _sync(self.fileOut)
+        self.fileOut.close()
+        os.remove(self.journal)
+        self.closed = True
+
+
+def recoverAppend(filename):
+    """ Restore a file left by an interrupted KMLAppendWriter from its journal. Return whether it was restored.
+    
+    A file whose closing tags were already written back completely is kept with the appended elements.
+    
+    """
+    journal = filename + ".journal"
+    if os.path.exists(journal + ".tmp"):
+        # Interrupted before the file was changed
+        os.remove(journal + ".tmp")
+    if not os.path.exists(journal):
+        return False
+    with open(journal, "rb") as f:
+        position = int(f.readline())
+        tail = f.read()
+    with open(filename, "r+b") as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(position, size - len(tail)))
+        if size < position + len(tail) or f.read() != tail:
+            f.seek(position)
+            f.truncate()
+            f.write(tail)
+            _sync(f)
+    os.remove(journal)
+    return True
 
-xdm.Element = Element
+def _sync(f):
+    """ Flush a file to disk """
+    f.flush()
+    os.fsync(f.fileno())
 
+def _writeJournal(journal, position, tail):
+    """ Save the position and the closing tags of a file being appended to. The journal appears complete or not at all. """
+    with open(journal + ".tmp", "wb") as f:
+        f.write("%d\n" % position)
+        f.write(tail)
+        _sync(f)
+    os.rename(journal + ".tmp", journal)
 
-def parseDate(dateString, dayFirst=True):
-    """ Attempt to parse a date time string and return a string formatted for google earth as 'yyyy-mm-ddThh:mm:ssZ'. 
+# Closing tags of a document and of folders, with indentation of their line
+_documentEnd = re.compile(r'[ \t]*</Document>\s*</kml>\s*\Z')
+_folderTags = re.compile(r'<(/?)Folder>')
+
+def _findTrailer(f, folderName=None):
+    """ Find where elements should be appended to a KML file.
     
-    Arguments:
-    dateString - A date and time in an any format as string
-    dayFirst - specifies if in case of ambiguous dates first number should be day or month. 
+    Return the offset of the line with the closing </Document> tag, or the closing tag of the last folder named
+    folderName, everything from there to the end of the file and the nesting depth of the appended elements.
     
-    Returns 0 on failure.
+    """
+    f.seek(0, 2)
+    size = f.tell()
+    if folderName is not None:
+        target = "<name>%s</name>" % _escape(folderName).encode('UTF-8')
+    # Read larger parts of the end of the file until the closing tag is found
+    start = size
+    blockSize = 1 << 16
+    while start > 0:
+        start = max(0, size - blockSize)
+        blockSize *= 4
+        f.seek(start)
+        data = f.read()
+        if folderName is None:
+            match = _documentEnd.search(data)
+            if match is None:
+                break
+            return _trailerAt(data, start, match.start())
+        end = len(data)
+        while True:
+            index = data.rfind(target, 0, end)
+            if index < 0:
+                break
+            opening = data.rfind("<Folder>", 0, index)
+            if opening < 0 and start > 0:
+                # The opening tag may be before the part that was read
+                break
+            if opening >= 0 and not data[opening + len("<Folder>"):index].strip():
+                closing = _matchingClose(data, opening)
+                if closing is not None:
+                    return _trailerAt(data, start, closing)
+            end = index
+    if folderName is None:
+        raise ValueError("No closing </Document></kml> tags at the end of %s" % f.name)
+    raise ValueError("No folder named %s in %s" % (folderName, f.name))
+
+def _matchingClose(data, opening):
+    """ Return index of the </Folder> tag closing the folder opened at the given index """
+    depth = 0
+    for match in _folderTags.finditer(data, opening):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.start()
+    return None
+
+def _trailerAt(data, start, index):
+    """ Return offset, tail and depth of children of the closing tag at data[index:], from the start of its line.
+    
+    Data is the part of the file from the offset start.
     
     """
-    try:
-        dt = dtparser.parse(dateString, dayfirst=dayFirst)
-        return dt.isoformat() + "Z"
-    except:        
-        return 0
+    line = index
+    while line > 0 and data[line - 1] in " \t":
+        line -= 1
+    tail = data[line:]
+    indent = len(tail) - len(tail.lstrip(" \t"))
+    return start + line, tail, indent // len(INDENT) + 1
 
 
-# Doesn't belong here but added for convenience
-def readCSVFile(filename, delim=',', dialect=None):
-    """ Read a CSV file. Return an array of data rows as dictionaries in {field_name: value} format. 
+class KMLReader:
+    """ Streaming KML reader.
     
-    Arguments:
-    filename - a path to the file to read
-    delim - CSV file delimiter
-    dialect - csv.Dialect object to use for parsing the file
+    Reads a KML file with iterparse and yields Style, StyleMap, Schema, Folder, Point, Path, Polygon, Track and
+    GroundOverlay objects one at a time, in document order. Every element is removed from the parsed tree as soon as
+    it has been converted, so memory use doesn't depend on the size of the file.
+    
+    Iterating over the reader yields (folders, element) pairs, where folders is a tuple of names of the folders
+    containing the element. A Folder is yielded before its content. Document name and description are available as
+    title and description once they have been read, which is before the first element in files written by this
+    module.
+    
+    Placemarks this module can't write (e.g. MultiGeometry) and other features are skipped and counted in skipped.
+    Inner boundaries of polygons and styles other than icon, line, polygon and balloon styles are left out.
+    
+    Example:
+    reader = kml.KMLReader("example.kml")
+    with kml.KMLStreamWriter("points.kml", reader.title) as out:
+        for folders, element in reader:
+            if isinstance(element, (kml.Style, kml.StyleMap, kml.Point)):
+                out.addElement(element)
     
     """
-            
-    with open(filename, "r") as f:
-        if dialect:
-            reader = csv.DictReader(f, dialect=dialect)
-        else:
-            reader = csv.DictReader(f, delimiter=delim)
-        records = []
-        for row in reader:        
-            records.append(row)
+    
+    def __init__(self, source, arrays=False):
+        """ Init KMLReader
         
-    return records
-
-def writeKML(doc, filename):
-    """ Write a KML document to a file 
+        Arguments:
+        source - kml filename or a file object opened for reading
+        arrays - whether coordinates of paths, polygons and tracks should be numpy arrays instead of lists
+        
+        """
+        if arrays and numpy is None:
+            raise ImportError("numpy is required for reading coordinates as arrays")
+        self.source = source
+        self.arrays = arrays
+        self.title = ""
+        self.description = ""
+        self.skipped = 0
         
+    def __iter__(self):
+        nodes = []
+        tags = []
+        folders = []
+        # Folders whose name hasn't been read yet, yielded with an empty name if they have no name
+        unnamed = []
+        for event, node in ElementTree.iterparse(self.source, events=('start', 'end')):
+            if event == 'start':
+                tag = _localName(node.tag)
+                if unnamed and (tag in _features or tag == 'Folder') and len(nodes) == unnamed[-1]:
+                    yield self.nameFolder(folders, unnamed, "")
+                nodes.append(node)
+                tags.append(tag)
+                if tag == 'Folder':
+                    unnamed.append(len(nodes))
+                continue
+            nodes.pop()
+            tag = tags.pop()
+            parent = tags[-1] if tags else None
+            if parent not in _containers:
+                continue
+            if tag == 'Folder':
+                if unnamed and unnamed[-1] == len(nodes) + 1:
+                    yield self.nameFolder(folders, unnamed, "")
+                folders.pop()
+            elif tag in ('name', 'description'):
+                text = node.text or ""
+                if parent == 'Folder' and unnamed and unnamed[-1] == len(nodes):
+                    yield self.nameFolder(folders, unnamed, text)
+                elif parent == 'Document':
+                    setattr(self, 'title' if tag == 'name' else tag, text)
+            elif tag in _features:
+                element = self.element(tag, node)
+                if element is None:
+                    self.skipped += 1
+                else:
+                    yield tuple(folders), element
+            # Processed children are removed, so only the open elements are kept in memory
+            nodes[-1].remove(node)
+            
+    def nameFolder(self, folders, unnamed, name):
+        """ Return a newly named folder with its parent folders and open it """
+        unnamed.pop()
+        parents = tuple(folders)
+        folders.append(name)
+        return parents, Folder(name)
+            
+    def element(self, tag, node):
+        """ Convert a parsed element to a module object. Return None if it can't be converted. """
+        if tag == 'Placemark':
+            return _readPlacemark(node, self.arrays)
+        if tag == 'Style':
+            return _readStyle(node)
+        if tag == 'StyleMap':
+            return _readStyleMap(node)
+        if tag == 'Schema':
+            return _readSchema(node)
+        if tag == 'GroundOverlay':
+            return _readGroundOverlay(node)
+        return None
+
+    
+def readKML(source, arrays=False, dedupeStyles=False):
+    """ Read a KML file to a KMLDocument. Return the KMLDocument.
+    
     Arguments:
-    doc - KMLDocument.document object to write
-    filename - kml output filename 
-       
+    source - kml filename or a file object opened for reading
+    arrays - whether coordinates of paths, polygons and tracks should be numpy arrays instead of lists
+    dedupeStyles - whether styles with the same content should be collapsed, see StyleRegistry
+    
+    The file is read with KMLReader, see it for the elements that are kept. Folders are found by name, so elements
+    of nested folders with the same name are all added to the first of them.
+    
     """
-    fileOut = open(filename, "w")
-    fileOut.write(doc.toprettyxml(indent="   ", encoding='UTF-8'))
-    fileOut.close()
+    reader = KMLReader(source, arrays)
+    elements = iter(reader)
+    first = next(elements, None)
+    kmldoc = KMLDocument(reader.title, reader.description, dedupeStyles=dedupeStyles)
+    for folders, element in itertools.chain([first] if first else [], elements):
+        if folders:
+            kmldoc.addElementToFolder(element, folders[-1])
+        else:
+            kmldoc.addElement(element)
+    return kmldoc
+
+# Elements converted by KMLReader and elements containing them
+_features = frozenset(['Placemark', 'Style', 'StyleMap', 'Schema', 'GroundOverlay', 'NetworkLink', 'ScreenOverlay', 'PhotoOverlay'])
+_containers = frozenset(['kml', 'Document', 'Folder'])
+
+# Tags without namespaces by tag, there are only a few different tags in a file
+_localNames = {}
+
+def _localName(tag):
+    """ Return an element tag without its namespace """
+    name = _localNames.get(tag)
+    if name is None:
+        name = _localNames[tag] = tag[tag.rfind('}') + 1:]
+    return name
+
+def _childMap(node):
+    """ Return a dictionary of the first children of a parsed element by tag """
+    children = {}
+    for child in reversed(node):
+        children[_localName(child.tag)] = child
+    return children
+
+def _children(node, tag):
+    """ Return children of a parsed element with the given tag in any namespace """
+    return [child for child in node if _localName(child.tag) == tag]
+
+def _child(node, *path):
+    """ Return the first element found by following tags from a parsed element, or None """
+    for tag in path:
+        if node is None:
+            return None
+        children = _children(node, tag)
+        node = children[0] if children else None
+    return node
+
+def _childText(node, *path, **kwargs):
+    """ Return text of the element found by following tags, or the default keyword argument if there isn't one """
+    child = _child(node, *path)
+    if child is None or child.text is None:
+        return kwargs.get('default', "")
+    return child.text.strip() if kwargs.get('strip', True) else child.text
+
+def _styleId(url):
+    """ Return style id of a local styleUrl """
+    return url[1:] if url.startswith("#") else url or None
+
+# Whitespace around commas inside coordinate tuples, written by formatCoordinates
+_tupleSpaces = re.compile(r'\s*,\s*')
+
+def _readCoordinates(text, arrays=False):
+    """ Parse a <coordinates> string to latitudes, longitudes and altitudes. Altitudes are None if all are 0. """
+    tuples = _tupleSpaces.sub(',', text.strip()).split()
+    if not tuples:
+        return ([], [], None) if not arrays else (numpy.zeros(0), numpy.zeros(0), None)
+    dims = tuples[0].count(',') + 1
+    values = " ".join(tuples).replace(',', ' ').split()
+    if len(values) != dims * len(tuples) or dims < 2:
+        # Tuples with and without altitudes, missing altitudes are 0
+        dims = 3
+        values = []
+        for item in tuples:
+            tupleValues = item.split(',')
+            values.extend(tupleValues[:3] + ["0"] * (3 - len(tupleValues)))
+    if arrays:
+        values = numpy.array(values, dtype=float).reshape(-1, dims)
+        lats, lons = values[:, 1].copy(), values[:, 0].copy()
+        alts = values[:, 2].copy() if dims > 2 and values[:, 2].any() else None
+    else:
+        values = [float(value) for value in values]
+        lats, lons = values[1::dims], values[0::dims]
+        alts = values[2::dims] if dims > 2 and any(values[2::dims]) else None
+    return lats, lons, alts
+
+def _readExtendedData(ext):
+    """ Return data dictionary and schema id of a parsed ExtendedData element, or (None, None) if there isn't one """
+    if ext is None:
+        return None, None
+    data = collections.OrderedDict()
+    schema = None
+    for child in ext:
+        tag = _localName(child.tag)
+        if tag == 'Data':
+            data[child.get('name')] = _childText(child, 'value', strip=False)
+        elif tag == 'SchemaData':
+            schema = _styleId(child.get('schemaUrl', ""))
+            for simpleData in _children(child, 'SimpleData'):
+                data[simpleData.get('name')] = simpleData.text or ""
+    return data or None, schema
+
+def _readPlacemark(node, arrays):
+    """ Convert a parsed Placemark to a Point, Path, Polygon or Track. Return None for other geometries. """
+    children = _childMap(node)
+    name = _childText(children.get('name'), strip=False)
+    description = _childText(children.get('description'), strip=False)
+    style = _styleId(_childText(children.get('styleUrl')))
+    when = _childText(children.get('TimeStamp'), 'when')
+    begin = _childText(children.get('TimeSpan'), 'begin')
+    end = _childText(children.get('TimeSpan'), 'end')
+    data, schema = _readExtendedData(children.get('ExtendedData'))
     
-def printKML(doc):
-    """ Print a KML document to the teminal """
-    print doc.toprettyxml(indent="   ", encoding='UTF-8')
+    geometry = children.get('Point')
+    if geometry is not None:
+        coordinates = _childText(geometry, 'coordinates')
+        try:
+            values = coordinates.split(',')
+            lat, lon = float(values[1]), float(values[0])
+        except (IndexError, ValueError):
+            # Not a single 'longitude, latitude, altitude' tuple
+            lats, lons, alts = _readCoordinates(coordinates)
+            if not lats:
+                return None
+            lat, lon = lats[0], lons[0]
+        return Point(lat, lon, name, description, datetime=when, startDate=begin, endDate=end, style=style, data=data, schema=schema)
     
-def getText(nodelist):
-    """ Get string from text nodes """
-    txt = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            txt.append(node.data)
-    return "".join(txt)
+    geometry = children.get('LineString')
+    if geometry is not None:
+        lats, lons, alts = _readCoordinates(_childText(geometry, 'coordinates'), arrays)
+        if when:
+            # A path has no TimeStamp, a time span of a single moment is used instead
+            begin = end = when
+        return Path(lats, lons, alts, int(_childText(geometry, 'extrude', default="0")),
+                    int(_childText(geometry, 'tessellate', default="0")),
+                    _childText(geometry, 'altitudeMode', default="clampToGround"), begin, end, name, description,
+                    style, data=data, schema=schema)
     
+    geometry = children.get('Polygon')
+    if geometry is not None:
+        lats, lons, alts = _readCoordinates(_childText(geometry, 'outerBoundaryIs', 'LinearRing', 'coordinates'), arrays)
+        return Polygon(name, description, style=style, extrude=int(_childText(geometry, 'extrude', default="0")),
+                       altitudeMode=_childText(geometry, 'altitudeMode', default="clampToGround"), latsArray=lats,
+                       lonsArray=lons, altsArray=alts, data=data, schema=schema)
+    
+    geometry = children.get('Track')
+    if geometry is not None:
+        whens = [child.text.strip() for child in _children(geometry, 'when')]
+        # gx:coord values are separated by spaces, one coordinate per element
+        coords = " ".join(",".join(child.text.split()) for child in _children(geometry, 'coord'))
+        lats, lons, alts = _readCoordinates(coords, arrays)
+        return Track(whens, lats, lons, alts, int(_childText(geometry, 'extrude', default="0")),
+                     _childText(geometry, 'altitudeMode', default="clampToGround"), name, description, style,
+                     data=data, schema=schema)
+    return None
 
-class KMLDocument:
-    """ KML document class """
+def _readStyle(node):
+    """ Convert a parsed Style to a Style object """
+    values = {}
+    for key, tag in (('icon', 'IconStyle'), ('line', 'LineStyle'), ('poly', 'PolyStyle'), ('balloon', 'BalloonStyle')):
+        child = _child(node, tag)
+        if child is None:
+            continue
+        values[key] = {}
+        for item in child:
+            itemTag = _localName(item.tag)
+            if itemTag == 'Icon':
+                values[key]['icon'] = _childText(item, 'href')
+            elif item.text is not None and item.text.strip():
+                values[key][itemTag] = item.text.strip() if itemTag != 'text' else item.text
+    return Style(node.get('id', ""), **values)
+
+def _readStyleMap(node):
+    """ Convert a parsed StyleMap to a StyleMap object """
+    styles = {}
+    for pair in _children(node, 'Pair'):
+        url = _childText(pair, 'styleUrl')
+        if url:
+            styles[_childText(pair, 'key')] = url
+    return StyleMap(node.get('id', ""), styles)
+
+def _readSchema(node):
+    """ Convert a parsed Schema to a Schema object """
+    fields = []
+    for field in _children(node, 'SimpleField'):
+        displayName = _childText(field, 'displayName', strip=False)
+        fields.append((field.get('name'), field.get('type', "string")) + ((displayName,) if displayName else ()))
+    return Schema(node.get('id', ""), fields, node.get('name'))
+
+def _readGroundOverlay(node):
+    """ Convert a parsed GroundOverlay to a GroundOverlay object. Return None if it has no LatLonBox. """
+    box = _child(node, 'LatLonBox')
+    if box is None:
+        return None
+    return GroundOverlay(_childText(node, 'name', strip=False), _childText(node, 'description', strip=False),
+                         _childText(node, 'Icon', 'href'), float(_childText(box, 'north')),
+                         float(_childText(box, 'south')), float(_childText(box, 'east')),
+                         float(_childText(box, 'west')), float(_childText(box, 'rotation', default="0")))
+
+
+def mergeKML(sources, output, title="", bbox=None, start=None, end=None, predicate=None, mergeFolders=True, processes=None, dedupeStyles=True, maxOpenFiles=32, compact=False):
+    """ Merge many KML files into one, keeping placemarks that match the given filters. Return number of placemarks
+    written.
     
-    def __init__(self, title, description=""):
-        """ Init KMLDocument """       
-        self.title = title
-        self.description = description
-        self.document = self.kml()
-        self.folders = []                
-        
-    def kml(self):
-        """ Creates KML document and returns DOM document """
-        doc = xdm.Document()
-        
-        # <kml>
-        kml = doc.createElement('kml')
-        kml.setAttribute('xmlns', 'http://www.opengis.net/kml/2.2')
-        doc.appendChild(kml)
+    Arguments:
+    sources - a list of kml filenames
+    output - kml output filename
+    title - title of the merged document
+    bbox - (south, west, north, east), only placemarks intersecting the box are kept if given
+    start - date string or datetime, only placemarks ending after it are kept if given
+    end - date string or datetime, only placemarks starting before it are kept if given
+    predicate - a function called with every placemark, the placemark is kept if it returns True. It's called in
+                worker processes, so it has to be a module level function.
+    mergeFolders - whether folders with the same name (and the same parent folders) in different files should be
+                   merged into one. Folders of every file are kept separate otherwise.
+    processes - number of worker processes reading the files, they are read by the calling process if not given
+    dedupeStyles - whether styles with the same content in different files should be collapsed to one
+    maxOpenFiles - maximum number of temporary folder files kept open at the same time
+    compact - whether the output should be written without indentation and newlines
+    
+    Files are read with KMLReader and placemarks are streamed through temporary files, one per output folder, so
+    memory use doesn't depend on the number or size of the files. Placemarks without dates are always shown in KML,
+    so they are kept by a time filter. Folders left without placemarks are left out.
+    
+    Styles, style maps and schemas are written first. Style ids used by more than one file for different styles are
+    renamed (e.g. track_2) and references to them in the file that uses them are rewritten.
+    
+    """
+    if isinstance(start, basestring):
+        start = _parseTime(start)
+    if isinstance(end, basestring):
+        end = _parseTime(end)
+    tmpdir = tempfile.mkdtemp(prefix="kml_merge")
+    jobs = [(filename, os.path.join(tmpdir, "input%d" % i), bbox, start, end, predicate) for i, filename in enumerate(sources)]
+    styles = _MergedStyles(dedupeStyles)
+    # Child folder keys of every output folder in first seen order
+    children = {(None, ()): []}
+    written = 0
+    
+    out = KMLStreamWriter(output, title, dedupeStyles=False, compact=compact)
+    spools = _FolderSpools(tmpdir, maxOpenFiles, out.indent, out.newl)
+    try:
+        for index, (styleElements, spoolName) in enumerate(_mapInputs(_readFiltered, jobs, processes)):
+            renames = styles.add(styleElements, out)
+            with open(spoolName, "rb") as spool:
+                while True:
+                    try:
+                        folders, element = cPickle.load(spool)
+                    except EOFError:
+                        break
+                    if isinstance(element, Placemark):
+                        element.style = renames.get(element.style, element.style)
+                        element.schema = renames.get(element.schema, element.schema)
+                    key = (None if mergeFolders or not folders else index, folders)
+                    if key not in children:
+                        _addFolderKey(children, key)
+                    spools.add(key, element)
+                    written += 1
+            os.remove(spoolName)
+        spools.flushAll()
+        spools.close()
         
-        # <document>
-        document = doc.createElement('Document')
-        kml.appendChild(document)
+        # Folders are written with their placemarks once all files have been read
+        def writeFolder(key):
+            if key in spools.files:
+                out.writer.flush()
+                with open(spools.files[key], "rb") as spool:
+                    shutil.copyfileobj(spool, out.fileOut)
+            for child in children[key]:
+                out.beginFolder(child[1][-1])
+                writeFolder(child)
+                out.endFolder()
+        writeFolder((None, ()))
+        out.close()
+    finally:
+        spools.close()
+        if not out.closed:
+            out.detach()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return written
+
+class _FolderSpools:
+    """ Temporary files with serialized placemarks of output folders of mergeKML.
+    
+    Consecutive points of a folder are written as a PointBatch, which is much faster than writing single points and
+    gives the same output.
+    
+    """
+    
+    # Maximum number of points written as a single PointBatch
+    batchSize = 1000
+    
+    def __init__(self, tmpdir, maxOpenFiles, addindent, newl):
+        self.tmpdir = tmpdir
+        self.maxOpenFiles = maxOpenFiles
+        self.addindent = addindent
+        self.newl = newl
+        # Output folder key -> temporary file name, open writers in least recently used order and pending points
+        self.files = {}
+        self.writers = collections.OrderedDict()
+        self.points = {}
         
-        # <name>
-        docName = doc.createElement('name')
-        document.appendChild(docName)    
-        docNameText = doc.createTextNode(self.title)
-        docName.appendChild(docNameText)
+    def add(self, key, element):
+        """ Add an element to the folder with the given key """
+        pending = self.points.get(key)
+        batch = _batchKey(element)
+        if pending is not None and (batch != pending[0] or len(pending[1]) >= self.batchSize):
+            self.flush(key)
+            pending = None
+        if batch is None:
+            self.write(key, element)
+        elif pending is None:
+            self.points[key] = (batch, [element])
+        else:
+            pending[1].append(element)
+            
+    def flush(self, key):
+        """ Write pending points of a folder """
+        (schema, fields, precision), points = self.points.pop(key)
+        data = [point.data for point in points] if fields is not None else None
+        self.write(key, PointBatch([point.lat for point in points], [point.lon for point in points],
+                                   [point.name for point in points], [point.description for point in points],
+                                   [point.dt for point in points], [point.style for point in points], data, schema,
+                                   list(fields or ()), precision))
         
-        # <description>
-        docDesc = doc.createElement('description')    
-        document.appendChild(docDesc)    
-        docDescText = doc.createTextNode(self.description)
-        docDesc.appendChild(docDescText)
+    def write(self, key, element):
+        """ Serialize an element to the temporary file of a folder """
+        writer = self.writers.pop(key, None)
+        if writer is None:
+            if len(self.writers) >= self.maxOpenFiles:
+                self.writers.popitem(last=False)[1].close()
+            if key not in self.files:
+                self.files[key] = os.path.join(self.tmpdir, "folder%d" % len(self.files))
+            writer = codecs.getwriter('UTF-8')(open(self.files[key], "ab"))
+        self.writers[key] = writer
+        _writeElement(writer, element, len(key[1]) + 2, addindent=self.addindent, newl=self.newl)
         
-        return doc
+    def flushAll(self):
+        """ Write pending points of all folders """
+        for key in self.points.keys():
+            self.flush(key)
+            
+    def close(self):
+        """ Close the temporary files """
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+def _batchKey(element):
+    """ Return (schema, data fields, precision) of a point that can be written in a PointBatch, or None """
+    if type(element) is not Point or element.sdt:
+        return None
+    return element.schema, tuple(_dataFields(element.data)) if element.data else None, element.precision
+
+def _addFolderKey(children, key):
+    """ Add an output folder key and its parent folders to the folder tree """
+    group, folders = key
+    parent = (group if len(folders) > 1 else None, folders[:-1])
+    if parent not in children:
+        _addFolderKey(children, parent)
+    children[parent].append(key)
+    children[key] = []
+
+def _mapInputs(function, jobs, processes):
+    """ Return a generator of results of a function for every job in order, run by worker processes if given.
     
-    def addElement(self, element):
-        """ Add an element to the document 
-        
-        Arguments:
-        element - xml.dom.minidom.Document object to be added
-        
-        """
-        self.document.documentElement.getElementsByTagName('Document')[0].appendChild(element.kml().documentElement)
+    At most two jobs per process are run ahead of the result being read, so temporary files of workers don't pile up.
+    
+    """
+    if processes is None or processes < 2 or sys.platform == 'win32':
+        for job in jobs:
+            yield function(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        jobs = iter(jobs)
+        for job in itertools.islice(jobs, 2 * processes):
+            pending.append(pool.apply_async(function, (job,)))
+        while pending:
+            result = pending.popleft().get()
+            for job in itertools.islice(jobs, 1):
+                pending.append(pool.apply_async(function, (job,)))
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _readFiltered(job):
+    """ Read a KML file, keeping styles and writing placemarks that match the filters to a temporary file.
+    
+    Return the styles and the name of the temporary file with pickled (folders, element) pairs.
+    
+    """
+    filename, spoolName, bbox, start, end, predicate = job
+    styles = []
+    with open(spoolName, "wb") as spool:
+        pickler = cPickle.Pickler(spool, cPickle.HIGHEST_PROTOCOL)
+        for folders, element in KMLReader(filename):
+            if isinstance(element, (Style, StyleMap, Schema)):
+                styles.append(element)
+            elif isinstance(element, Folder):
+                continue
+            elif _matches(element, bbox, start, end, predicate):
+                pickler.dump((folders, element))
+                # Elements aren't referenced more than once, the memo would only keep them in memory
+                pickler.clear_memo()
+    return styles, spoolName
+
+def _matches(element, bbox, start, end, predicate):
+    """ Return whether an element passes bounding box, time and predicate filters """
+    if bbox is not None:
+        bounds = _elementBounds(element)
+        if bounds is None:
+            return False
+        south, west, north, east = bounds
+        if south > bbox[2] or north < bbox[0] or west > bbox[3] or east < bbox[1]:
+            return False
+    if start is not None or end is not None:
+        span = _elementSpan(element)
+        if span is not None:
+            first, last = span
+            if start is not None and last is not None and last < start:
+                return False
+            if end is not None and first > end:
+                return False
+    return predicate is None or predicate(element)
+
+def _elementSpan(element):
+    """ Return first and last date of an element as naive UTC datetimes, or None if it has no dates.
+    
+    The last date is None for a TimeSpan without an end.
+    
+    """
+    begin, end = _elementDates(element)
+    if not begin:
+        return None
+    return _parseTime(begin), _parseTime(end) if end else None
+
+
+class _MergedStyles:
+    """ Styles and schemas written by mergeKML, with ids made unique across files """
+    
+    def __init__(self, dedupe):
+        self.dedupe = dedupe
+        # Content key -> id written for it, and all ids written
+        self.ids = {}
+        self.used = set()
         
-    def addElements(self, *elements):
-        """ Convenience method for adding multiple elements """
+    def add(self, elements, out):
+        """ Write styles of a single file. Return a dictionary of new ids of styles and schemas of the file. """
+        renames = {}
+        # Style maps refer to styles, so styles have to be renamed first
+        elements = sorted(elements, key=lambda element: isinstance(element, StyleMap))
         for element in elements:
-            self.addElement(element)
-        
-    def addFolder(self, folder):
-        """ Add folder to the document """
-        self.addElement(folder)
-        folderName = getText(folder.kml().getElementsByTagName("name")[0].childNodes)        
-        self.folders.append(folderName)
-        
-    def addElementToFolder(self, element, folderName):
-        """ Add element to the folder 
-        
-        The folder needs to be created earlier and added to the KMLDocument.
-       
-        """        
-        def getFolderByName(name):
-            folders = self.document.documentElement.getElementsByTagName('Folder')
-            for folder in folders:
-                if getText(folder.getElementsByTagName("name")[0].childNodes) == name:
-                    return folder
-                
-        if folderName in self.folders:
-            f = getFolderByName(folderName)
-            f.appendChild(element.kml().documentElement)                       
-        else:
-            print "No folder named %s. Please create it first." % folderName
+            if isinstance(element, StyleMap):
+                element = StyleMap(element.id, dict((k, self.renameUrl(v, renames)) for k, v in element.styles.items()))
+            if isinstance(element, Schema):
+                key = ('Schema', element.name, tuple(element.fields))
+            else:
+                key = element.key()
+            if self.dedupe and key in self.ids:
+                renames[element.id] = self.ids[key]
+                continue
+            newId = element.id
+            count = 1
+            while newId in self.used:
+                count += 1
+                newId = "%s_%d" % (element.id, count)
+            self.used.add(newId)
+            self.ids.setdefault(key, newId)
+            renames[element.id] = newId
+            element.id = newId
+            out.addElement(element)
+        return renames
+    
+    def renameUrl(self, url, renames):
+        """ Return a styleUrl referring to a renamed style """
+        url = str(url)
+        if url.startswith('#') and url[1:] in renames:
+            return '#' + renames[url[1:]]
+        return url
 
 
-class Style:
+class Style(object):
     """ Style class. 
     
     Represents a Style element in Google Earth KML file.
@@ -225,7 +3344,9 @@ class Style:
     A Style defines the look of placemarks such as points, paths and polygons.  
     
     """    
-    def __init__(self, id, icon=None, line=None, poly=None):
+    __slots__ = ('id', 'icon', 'line', 'poly', 'balloon')
+    
+    def __init__(self, id, icon=None, line=None, poly=None, balloon=None):
         """ Init Style
         
         Arguments:
@@ -233,6 +3354,7 @@ class Style:
         icon - defines IconStyle element
         line - defines LineStyle element
         poly - defines PolyStyle element
+        balloon - defines BalloonStyle element, a string is used as its text
         
         These arguments should be dictionaries with key - value pairs for the elements they define. A single style
         can be used for more than one type of element. Styles should be added to the document before they are used.
@@ -249,15 +3371,25 @@ class Style:
         
         whitePointStyle = Style('whitePoint', icon=pointstyle)
         
+        # A balloon showing ExtendedData fields of the placemark
+        balloonstyle = {'text': '<b>$[name]</b><br/>Speed: $[speed] km/h', 'bgColor': 'ffffffbb'}
+        
         """
         self.id = id
         self.icon = icon
         self.line = line
         self.poly = poly
+        if isinstance(balloon, basestring):
+            balloon = {'text': balloon}
+        self.balloon = balloon
+        
+    def key(self):
+        """ Return a hashable key of the style content, without its id """
+        return ('Style', _itemsKey(self.icon), _itemsKey(self.line), _itemsKey(self.poly), _itemsKey(self.balloon))
         
     def kml(self):
         """ Create Style node. Return xml.dom.minidom.Document """
-        doc = xdm.Document()
+        doc = Document()
         
         # <Style>
         style = doc.createElement('Style')        
@@ -267,6 +3399,7 @@ class Style:
         # <IconStyle>
         if self.icon:
             iconstyle = doc.createElement('IconStyle')
+            style.appendChild(iconstyle)
             for k, v in self.icon.items():
                 if k.lower() == "icon":
                     iconNode = doc.createElement('Icon')
@@ -300,15 +3433,31 @@ class Style:
                 polystyle.appendChild(kNode)
                 kValue = doc.createTextNode(v)
                 kNode.appendChild(kValue)
+                
+        # <BalloonStyle>
+        if self.balloon:
+            balloonstyle = doc.createElement('BalloonStyle')
+            style.appendChild(balloonstyle)
+            for k, v in self.balloon.items():
+                kNode = doc.createElement(k)
+                balloonstyle.appendChild(kNode)
+                kValue = doc.createTextNode(v)
+                kNode.appendChild(kValue)
         
         return doc
     
     
-class StyleMap:
+def _itemsKey(items):
+    """ Return a dictionary of style values as a sorted tuple of pairs, or None if it's empty """
+    return tuple(sorted(items.items())) if items else None
+
+
+class StyleMap(object):
     """ StyleMap class. 
     
     Represents a Google Earth StyleMap which maps element state to a style.
     """
+    __slots__ = ('id', 'styles')
     
     def __init__(self, id, styles):
         """ Init StyleMap
@@ -325,9 +3474,13 @@ class StyleMap:
         self.id = id
         self.styles = styles
         
+    def key(self):
+        """ Return a hashable key of the style map content, without its id """
+        return ('StyleMap', tuple(sorted((k, str(v)) for k, v in self.styles.items())))
+        
     def kml(self):
         """ Create StyleMap node. Return xml.dom.minidom.Document """
-        doc = xdm.Document()
+        doc = Document()
         
         # <Style>
         stylemap = doc.createElement('StyleMap')        
@@ -350,21 +3503,159 @@ class StyleMap:
         return doc                
        
 
+class Schema(object):
+    """ Schema class.
+    
+    Declares typed fields of ExtendedData. Placemarks refer to it by id with their schema argument and write their
+    data as SchemaData, so values are stored once per placemark without repeating any html. A BalloonStyle can show
+    the fields with $[schemaName/field] entities, see balloonText.
+    
+    """
+    __slots__ = ('id', 'fields', 'name')
+    
+    def __init__(self, id, fields, name=None):
+        """ Init Schema
+        
+        Arguments:
+        id - schema id used by placemarks
+        fields - a list of field names or (name, type) or (name, type, displayName) tuples. Type is one of string,
+                 int, uint, short, ushort, float, double or bool, string is used for plain names.
+        name - schema name used in balloon entities, the same as id if not given
+        
+        Example:
+        schema = Schema('measurement', [('station', 'string'), ('speed', 'double', 'Speed [km/h]')])
+        style = Style('measured', balloon=schema.balloonText())
+        point = Point(50.06, 19.94, style='measured', schema='measurement', data={'station': 'KRK', 'speed': 12.5})
+        
+        """
+        self.id = id
+        self.fields = [(field,) if isinstance(field, basestring) else tuple(field) for field in fields]
+        self.name = name or id
+        
+    def balloonText(self):
+        """ Return a BalloonStyle text showing all fields in a table """
+        rows = ["<tr><td>%s</td><td>$[%s/%s]</td></tr>" % (field[2] if len(field) > 2 else field[0], self.name, field[0])
+                for field in self.fields]
+        return "<table>%s</table>" % "".join(rows)
+        
+    def kml(self):
+        """ Create Schema node. Return xml.dom.minidom.Document """
+        doc = Document()
+        
+        # <Schema>
+        schema = doc.createElement('Schema')
+        doc.appendChild(schema)
+        schema.setAttribute("name", self.name)
+        schema.setAttribute("id", self.id)
+        
+        # <SimpleField>
+        for field in self.fields:
+            simpleField = doc.createElement('SimpleField')
+            schema.appendChild(simpleField)
+            simpleField.setAttribute("name", field[0])
+            simpleField.setAttribute("type", field[1] if len(field) > 1 else "string")
+            # <displayName>
+            if len(field) > 2:
+                displayName = doc.createElement('displayName')
+                simpleField.appendChild(displayName)
+                displayNameText = doc.createTextNode(field[2])
+                displayName.appendChild(displayNameText)
+                
+        return doc
+
+
+def schemaFromRows(schemaId, rows, fields=None, sampleSize=100):
+    """ Create a Schema for data rows, e.g. from readCSVFile, with field types detected from the values.
+    
+    Arguments:
+    schemaId - schema id
+    rows - a list of dictionaries
+    fields - a list of field names to include, all fields of the first row in sorted order if not given
+    sampleSize - number of rows used to detect types
+    
+    Fields with integer values in all sampled rows are typed int, with numbers double, and other fields string.
+    
+    """
+    sample = list(itertools.islice(rows, sampleSize))
+    if fields is None:
+        fields = sorted(sample[0]) if sample else []
+    types = []
+    for field in fields:
+        values = [row.get(field) for row in sample if row.get(field) not in (None, "")]
+        if values and all(_isNumber(value, int) for value in values):
+            types.append((field, 'int'))
+        elif values and all(_isNumber(value, float) for value in values):
+            types.append((field, 'double'))
+        else:
+            types.append((field, 'string'))
+    return Schema(schemaId, types)
+
+def _isNumber(value, numberType):
+    """ Return whether a value can be converted to the given number type """
+    try:
+        numberType(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+    
+def _dataFields(data):
+    """ Return field names of a data dictionary, in order for OrderedDict and sorted otherwise """
+    if isinstance(data, collections.OrderedDict):
+        return data.keys()
+    return sorted(data)
+
+def _dataText(value):
+    """ Return a data value as a string """
+    return value if isinstance(value, basestring) else str(value)
+
+def _appendExtendedData(doc, parent, data, schema):
+    """ Append ExtendedData node with data fields to a placemark node. Fields with None values are skipped. """
+    # <ExtendedData>
+    ext = doc.createElement('ExtendedData')
+    parent.appendChild(ext)
+    if schema:
+        # <SchemaData>
+        container = doc.createElement('SchemaData')
+        ext.appendChild(container)
+        container.setAttribute("schemaUrl", "#" + schema)
+    for field in _dataFields(data):
+        value = data[field]
+        if value is None:
+            continue
+        if schema:
+            # <SimpleData>
+            simpleData = doc.createElement('SimpleData')
+            container.appendChild(simpleData)
+            simpleData.setAttribute("name", field)
+            simpleData.appendChild(doc.createTextNode(_dataText(value)))
+        else:
+            # <Data>
+            dataNode = doc.createElement('Data')
+            ext.appendChild(dataNode)
+            dataNode.setAttribute("name", field)
+            # <value>
+            valueNode = doc.createElement('value')
+            dataNode.appendChild(valueNode)
+            valueNode.appendChild(doc.createTextNode(_dataText(value)))
+
+
 class Folder:
     """ Folder class """
     
-    def __init__(self, name):
+    def __init__(self, name, region=None):
         """ Init Folder class 
         
         Arguments:
         name - Folder name
+        region - a Region limiting when the folder is shown
         
         """
         self.name = name
+        self.region = region
         
     def kml(self):
         """ Creates Folder element in KML. Returns xml.dom.minidom.Document """
-        doc = xdm.Document()
+        doc = Document()
         
         # <Fodler>
         folder = doc.createElement('Folder')
@@ -376,22 +3667,33 @@ class Folder:
         nameText = doc.createTextNode(self.name)
         nameNode.appendChild(nameText)
         
+        # <Region>
+        if self.region is not None:
+            folder.appendChild(self.region.kml().documentElement)
+        
         return doc
 
     
-class Placemark:
+class Placemark(object):
     """ Placemark class. 
     
     A placemark element in Google Earth without any graphical representation (doesn't show on the map). 
     
+    Placemark classes define __slots__ instead of having an instance dictionary, which keeps large numbers of
+    placemarks held in memory small.
+    
     """
-    def __init__(self, name="", description=""):                
+    __slots__ = ('name', 'description', 'data', 'schema')
+    
+    def __init__(self, name="", description="", data=None, schema=None):                
         self.name = name
         self.description = description
+        self.data = data
+        self.schema = schema
         
     def kml(self):
         """ Creates placemark element in KML """
-        doc = xdm.Document()
+        doc = Document()
         
         # <Placemark>
         pm = doc.createElement('Placemark')
@@ -419,8 +3721,9 @@ class Point(Placemark):
     Represents a single point or a push pin in Google Earth.
     
     """
+    __slots__ = ('lat', 'lon', 'dt', 'sdt', 'edt', 'style', 'precision')
     
-    def __init__(self, latitude, longitude, name="", description="", datetime="", startDate="", endDate="", style=None):
+    def __init__(self, latitude, longitude, name="", description="", datetime="", startDate="", endDate="", style=None, data=None, schema=None, precision=None):
         """ Init Point.
         
         Arguments:
@@ -434,21 +3737,31 @@ class Point(Placemark):
         startDate - a date when the point appears
         endDate - a date when the point dissapears
         style - a style to use for the point
+        data - a dictionary of field values written as ExtendedData, e.g. a row from readCSVFile
+        schema - id of a Schema typing the data fields, untyped Data elements are written if not given
+        precision - number of decimals of coordinates, see formatCoordinates
         
         Note that time arguments are optional and are generally only used for animations. Either datetime or start and end dates should be used, not both.
         
         """
-        Placemark.__init__(self, name, description)
+        Placemark.__init__(self, name, description, data, schema)
         self.lat = latitude
         self.lon = longitude
         self.dt = datetime
         self.sdt = startDate
         self.edt = endDate
         self.style = style
+        self.precision = precision
         
-    def kml(self):
-        """ Create point node. Return xml.dom.minidom.Document. """
-        doc = xdm.Document()
+    def kml(self, precision=None):
+        """ Create point node. Return xml.dom.minidom.Document.
+        
+        Arguments:
+        precision - number of decimals of coordinates, used if the point has no precision of its own
+        
+        """
+        precision = self.precision if self.precision is not None else precision
+        doc = Document()
     
         # <Placemark>
         pm = doc.createElement('Placemark')
@@ -474,6 +3787,10 @@ class Point(Placemark):
             pm.appendChild(desc)
             descText = doc.createTextNode(self.description)
             desc.appendChild(descText)
+            
+        # <ExtendedData>
+        if self.data:
+            _appendExtendedData(doc, pm, self.data, self.schema)
         
         # <point>
         pt = doc.createElement('Point')
@@ -482,7 +3799,10 @@ class Point(Placemark):
         # <coordinates>
         coords = doc.createElement('coordinates')
         pt.appendChild(coords)
-        coordsText = doc.createTextNode('%s, %s, 0' %(self.lon, self.lat))
+        if precision is None:
+            coordsText = doc.createTextNode('%s, %s, 0' %(self.lon, self.lat))
+        else:
+            coordsText = doc.createTextNode(formatCoordinates([self.lat], [self.lon], precision=precision))
         coords.appendChild(coordsText)
         
         # <TimeStamp>
@@ -516,14 +3836,249 @@ class Point(Placemark):
         return doc
 
 
+class PointBatch:
+    """ PointBatch class.
+    
+    Represents many points given as parallel sequences (lists, array.array or numpy arrays). All placemarks are
+    written in one pass with string templates, so no DOM nodes are created for single points. The output is the same
+    as for Point objects created from the same values.
+    
+    """
+    
+    # Number of placemarks joined into a single write call
+    chunkSize = 10000
+    
+    def __init__(self, latitudes, longitudes, names=None, descriptions=None, datetimes=None, styles=None, data=None, schema=None, dataFields=None, precision=None):
+        """ Init PointBatch.
+        
+        Arguments:
+        latitudes - a sequence of geographical latitudes
+        longitudes - a sequence of geographical longitudes
+        names - a sequence of point names
+        descriptions - a sequence of point descriptions
+        datetimes - a sequence of TimeStamp dates, e.g. created with parseDate
+        styles - a sequence of style ids or a single style id used for all points
+        data - ExtendedData of the points, a sequence of row dictionaries (e.g. from readCSVFile) or a dictionary of
+               value sequences by field name
+        schema - id of a Schema typing the data fields, untyped Data elements are written if not given
+        dataFields - names of the data fields to write in order, all fields in sorted order if not given (taken
+                     from the first row for row dictionaries)
+        precision - number of decimals of coordinates, see formatCoordinates
+        
+        Optional sequences must have the same length as latitudes, a ValueError is raised otherwise. Empty values are
+        skipped like in Point.
+        
+        """
+        self.lats = latitudes
+        self.lons = longitudes
+        self.names = names
+        self.descriptions = descriptions
+        self.dts = datetimes
+        self.styles = styles
+        self.data = data
+        self.schema = schema
+        self.dataFields = dataFields
+        self.precision = precision
+        # Checked here rather than when the points are written, which may be after part of the output
+        columns = [longitudes, names, descriptions, datetimes]
+        if styles is not None and not isinstance(styles, basestring):
+            columns.append(styles)
+        if isinstance(data, dict):
+            columns.extend(data.get(field) for field in self.dataFieldNames())
+        else:
+            columns.append(data)
+        if any(column is not None and len(column) != len(latitudes) for column in columns):
+            raise ValueError("PointBatch sequences must have the same length")
+        
+    def __len__(self):
+        return len(self.lats)
+    
+    def points(self):
+        """ Return a generator of Point objects for all points of the batch """
+        columns = [self.names, self.descriptions, self.dts]
+        columns = [_toList(column) if column is not None else None for column in columns]
+        styles = self.styles
+        if styles is not None and not isinstance(styles, basestring):
+            styles = _toList(styles)
+        fields, dataColumns, present = self.dataColumns()
+        for i, (lat, lon) in enumerate(itertools.izip(_coordinateList(self.lats), _coordinateList(self.lons))):
+            name, description, dt = [column[i] or "" if column is not None else "" for column in columns]
+            style = styles[i] if isinstance(styles, list) else styles
+            data = None
+            if dataColumns is not None and (present is None or present[i]):
+                data = collections.OrderedDict((field, column[i]) for field, column in zip(fields, dataColumns))
+            yield Point(lat, lon, name=name, description=description, datetime=dt, style=style or None, data=data,
+                        schema=self.schema, precision=self.precision)
+            
+    def point(self, i):
+        """ Return the point at index i as a Point object """
+        def value(column, empty=""):
+            if column is None:
+                return empty
+            item = column[i]
+            # Numpy values are converted to plain python values, like in points()
+            if hasattr(item, 'item'):
+                item = item.item()
+            return empty if item is None or item == "" else item
+        style = self.styles if self.styles is None or isinstance(self.styles, basestring) else value(self.styles)
+        data = None
+        if self.data is not None:
+            fields = self.dataFieldNames()
+            if isinstance(self.data, dict):
+                data = collections.OrderedDict((field, value(self.data[field])) for field in fields)
+            elif self.data[i]:
+                data = collections.OrderedDict((field, self.data[i].get(field)) for field in fields)
+        return Point(_coordinateValue(self.lats[i]), _coordinateValue(self.lons[i]), name=value(self.names), description=value(self.descriptions),
+                     datetime=value(self.dts), style=style or None, data=data, schema=self.schema, precision=self.precision)
+            
+    def dataColumns(self):
+        """ Return data field names, a list of values of every field and a list of flags of points that have data.
+        
+        Columns are None if there is no data, flags are None if all points have data.
+        
+        """
+        if self.data is None:
+            return [], None, None
+        fields = self.dataFieldNames()
+        if isinstance(self.data, dict):
+            return fields, [_toList(self.data[field]) for field in fields], None
+        rows = self.data
+        present = [bool(row) for row in rows]
+        return fields, [[row.get(field) for row in rows] for field in fields], None if all(present) else present
+        
+    def dataFieldNames(self):
+        """ Return names of the data fields written for every point """
+        if self.dataFields or self.data is None:
+            return self.dataFields or []
+        if isinstance(self.data, dict):
+            return sorted(self.data)
+        return sorted(self.data[0]) if len(self.data) else []
+        
+    def dataTexts(self, fieldTemplates, dataOpen, dataClose, dataEmpty):
+        """ Return a list of ExtendedData strings of all points, None for points without data """
+        fields, columns, present = self.dataColumns()
+        if columns is None:
+            return None
+        # Values of a column are escaped with a single call, NUL can't appear in XML text
+        texts = []
+        for column in columns:
+            try:
+                text = "\0".join(column)
+            except TypeError:
+                # Not only strings
+                text = "\0".join(["" if value is None else _dataText(value) for value in column])
+            texts.append(_escape(text).split("\0"))
+        if present is None and all(None not in column for column in columns):
+            template = dataOpen.replace("%", "%%") + "".join(fieldTemplates) + dataClose.replace("%", "%%")
+            return [template % values for values in zip(*texts)] if texts else [dataEmpty] * len(self)
+        result = []
+        for i in xrange(len(self)):
+            if present is not None and not present[i]:
+                result.append(None)
+                continue
+            values = [template % text[i] for template, column, text in zip(fieldTemplates, columns, texts) if column[i] is not None]
+            result.append(dataOpen + "".join(values) + dataClose if values else dataEmpty)
+        return result
+        
+    def kml(self, precision=None):
+        """ Create a Fragment node writing all points. Return xml.dom.minidom.Document
+        
+        Arguments:
+        precision - number of decimals of coordinates, used if the batch has no precision of its own
+        
+        """
+        doc = Document()
+        if precision is None or self.precision is not None:
+            doc.appendChild(Fragment(self.render))
+        else:
+            doc.appendChild(Fragment(lambda writer, indent, addindent, newl: self.render(writer, indent, addindent, newl, precision)))
+        return doc
+    
+    def render(self, writer, indent, addindent, newl, precision=None):
+        """ Write all placemarks to the writer object, with precision used if the batch has none of its own """
+        precision = self.precision if self.precision is not None else precision
+        indent1 = indent + addindent
+        indent2 = indent1 + addindent
+        pmOpen = indent + "<Placemark>" + newl
+        pmClose = indent + "</Placemark>" + newl
+        nameTemplate = indent1 + "<name>%s</name>" + newl
+        styleTemplate = indent1 + "<styleUrl>#%s</styleUrl>" + newl
+        descTemplate = indent1 + "<description>%s</description>" + newl
+        # Values are separated without spaces in compact output, like coordinates of other elements
+        coordinatesTemplate = "%s, %s, 0" if newl else "%s,%s,0"
+        pointTemplate = indent1 + "<Point>" + newl + indent2 + "<coordinates>" + coordinatesTemplate + "</coordinates>" + newl + indent1 + "</Point>" + newl
+        whenTemplate = indent1 + "<TimeStamp>" + newl + indent2 + "<when>%s</when>" + newl + indent1 + "</TimeStamp>" + newl
+        
+        # <ExtendedData> with a template for every field
+        fields = self.dataFieldNames()
+        indent3 = indent2 + addindent
+        if self.schema:
+            schemaUrl = '<SchemaData schemaUrl="#%s"' % _escape(self.schema)
+            dataOpen = indent1 + "<ExtendedData>" + newl + indent2 + schemaUrl + ">" + newl
+            dataClose = indent2 + "</SchemaData>" + newl + indent1 + "</ExtendedData>" + newl
+            dataEmpty = indent1 + "<ExtendedData>" + newl + indent2 + schemaUrl + "/>" + newl + indent1 + "</ExtendedData>" + newl
+            fieldTemplates = [indent3 + '<SimpleData name="%s">' % _escapeFormat(field) + "%s</SimpleData>" + newl for field in fields]
+        else:
+            dataOpen = indent1 + "<ExtendedData>" + newl
+            dataClose = indent1 + "</ExtendedData>" + newl
+            dataEmpty = indent1 + "<ExtendedData/>" + newl
+            fieldTemplates = [indent2 + '<Data name="%s">' % _escapeFormat(field) + newl + indent3 + "<value>%s</value>" + newl + indent2 + "</Data>" + newl
+                              for field in fields]
+        data = self.dataTexts(fieldTemplates, dataOpen, dataClose, dataEmpty)
+        
+        lats = _coordinateList(self.lats)
+        lons = _coordinateList(self.lons)
+        if precision is not None:
+            # Coordinates of all points are formatted at once and written as a single value
+            coordinates = formatCoordinates(lats, lons, precision=precision).split("\n") if lats else []
+            pointTemplate = indent1 + "<Point>" + newl + indent2 + "<coordinates>%s</coordinates>" + newl + indent1 + "</Point>" + newl
+        names = self.names is not None and _toList(self.names)
+        descs = self.descriptions is not None and _toList(self.descriptions)
+        dts = self.dts is not None and _toList(self.dts)
+        styles = self.styles
+        if isinstance(styles, basestring):
+            style = styles and styleTemplate % _escape(styles)
+            styles = None
+        else:
+            style = None
+            styles = styles is not None and _toList(styles)
+        
+        parts = []
+        append = parts.append
+        for i in xrange(len(lats)):
+            append(pmOpen)
+            if names and names[i]:
+                append(nameTemplate % _escape(names[i]))
+            if style:
+                append(style)
+            elif styles and styles[i]:
+                append(styleTemplate % _escape(styles[i]))
+            if descs and descs[i]:
+                append(descTemplate % _escape(descs[i]))
+            if data and data[i] is not None:
+                append(data[i])
+            if precision is None:
+                append(pointTemplate % (lons[i], lats[i]))
+            else:
+                append(pointTemplate % coordinates[i])
+            if dts and dts[i]:
+                append(whenTemplate % _escape(dts[i]))
+            append(pmClose)
+            if len(parts) >= self.chunkSize:
+                writer.write("".join(parts))
+                del parts[:]
+        writer.write("".join(parts))
+    
+    
 class Path(Placemark):
     """ Path class.
     
     Represents a path (track) in Google Earth.
     
     """
+    __slots__ = ('lats', 'lons', 'alts', 'extrude', 'tess', 'altMode', 'sdt', 'edt', 'style', 'simplify', 'simplifyMethod', 'vertexCounts', 'precision')
     
-    def __init__(self, latsArray, lonsArray, altsArray=None, extrude=0, tessellate=0, altitudeMode="absolute", startDate="", endDate="", name="", description="", style=None):
+    def __init__(self, latsArray, lonsArray, altsArray=None, extrude=0, tessellate=0, altitudeMode="absolute", startDate="", endDate="", name="", description="", style=None, simplify=None, simplifyMethod="douglas-peucker", data=None, schema=None, precision=None):
         """ Init Path.
         
         Arguments:
@@ -538,12 +4093,20 @@ class Path(Placemark):
         name - track name
         description - track description, can use html
         style - a style to be used by the track
+        simplify - a tolerance in metres, the path is simplified when KML is created if given, see simplify()
+        simplifyMethod - douglas-peucker or visvalingam
+        data - a dictionary of field values written as ExtendedData
+        schema - id of a Schema typing the data fields
+        precision - number of decimals of coordinates, see formatCoordinates
         
         Note that date arguments are optional and not needed for a track that displays permanently. Altitudes are also not
         necessary for a flat track.        
         
+        Arrays can be lists, array.array or numpy arrays. After simplification vertexCounts holds numbers of vertices
+        before and after it.
+        
         """
-        Placemark.__init__(self, name, description)
+        Placemark.__init__(self, name, description, data, schema)
         self.lats = latsArray
         self.lons = lonsArray
         self.alts = altsArray
@@ -553,11 +4116,21 @@ class Path(Placemark):
         self.sdt = startDate
         self.edt = endDate        
         self.style = style
+        self.simplify = simplify
+        self.simplifyMethod = simplifyMethod
+        self.vertexCounts = None
+        self.precision = precision
        
                 
-    def kml(self):
-        """ Create Path node. Return xml.dom.minidom.Document """
-        doc = xdm.Document()
+    def kml(self, precision=None):
+        """ Create Path node. Return xml.dom.minidom.Document
+        
+        Arguments:
+        precision - number of decimals of coordinates, used if the path has no precision of its own
+        
+        """
+        precision = self.precision if self.precision is not None else precision
+        doc = Document()
     
         # <Placemark>
         pm = doc.createElement('Placemark')
@@ -601,6 +4174,10 @@ class Path(Placemark):
                 timespan.appendChild(end)
                 endText = doc.createTextNode(self.edt)
                 end.appendChild(endText)
+                
+        # <ExtendedData>
+        if self.data:
+            _appendExtendedData(doc, pm, self.data, self.schema)
         
         # <LineString>
         ls = doc.createElement('LineString')
@@ -623,26 +4200,187 @@ class Path(Placemark):
         # <coordinates>
         coords = doc.createElement('coordinates')
         ls.appendChild(coords)        
-        if not self.alts:
-            for lat, lon in zip(self.lats, self.lons):
-                coordsText = doc.createTextNode('%s, %s, 0' %(lon, lat))
-                coords.appendChild(coordsText)
+        lats, lons, alts = self.lats, self.lons, self.alts
+        if self.simplify is not None:
+            lats, lons, alts, self.vertexCounts = _simplifyArrays(lats, lons, alts, self.simplify, self.simplifyMethod)
+        coordsText = doc.createTextNode(formatCoordinates(lats, lons, alts, precision))
+        coords.appendChild(coordsText)
+        
+        return doc
+    
+    
+class Track(Placemark):
+    """ Track class.
+    
+    Represents a gx:Track, a series of timestamped positions shown as an animated track in Google Earth. Times and
+    coordinates are written as parallel <when> and <gx:coord> lists, which is much smaller and faster to write than
+    a Point with a TimeStamp for every sample.
+    
+    """
+    __slots__ = ('whens', 'lats', 'lons', 'alts', 'extrude', 'altMode', 'style', 'precision')
+    
+    def __init__(self, datetimes, latsArray, lonsArray, altsArray=None, extrude=0, altitudeMode="absolute", name="", description="", style=None, data=None, schema=None, precision=None):
+        """ Init Track.
+        
+        Arguments:
+        datetimes - an array of dates of the samples, e.g. created with parseDates
+        latsArray - an array of geographical latitudes
+        lonsArray - an array of geographical longitudes
+        altsArray - an array of altitudes, 0 is used if not given
+        extrude - whether the track should be extruded down to the ground
+        altitudeMode - specifies the way Google Earth reads altitude values (absolute|relativeToGround|relativeToSeaFloor|clampToGround|clampToSeaFloor)
+        name - track name
+        description - track description, can use html
+        style - a style to be used by the track
+        data - a dictionary of field values written as ExtendedData
+        schema - id of a Schema typing the data fields
+        precision - number of decimals of coordinates, see formatCoordinates
+        
+        Arrays can be lists, array.array or numpy arrays and must have the same length.
+        
+        """
+        Placemark.__init__(self, name, description, data, schema)
+        self.whens = datetimes
+        self.lats = latsArray
+        self.lons = lonsArray
+        self.alts = altsArray
+        self.extrude = extrude
+        self.altMode = altitudeMode
+        self.style = style
+        self.precision = precision
+        
+    def __len__(self):
+        return len(self.lats)
+        
+    def kml(self, precision=None):
+        """ Create Track node. Return xml.dom.minidom.Document
+        
+        Arguments:
+        precision - number of decimals of coordinates, used if the track has no precision of its own
+        
+        """
+        precision = self.precision if self.precision is not None else precision
+        doc = Document()
+    
+        # <Placemark>
+        pm = doc.createElement('Placemark')
+        doc.appendChild(pm)
+        
+        # <name>
+        if self.name != '':
+            nameNode = doc.createElement('name')
+            pm.appendChild(nameNode)
+            nameText = doc.createTextNode(self.name)
+            nameNode.appendChild(nameText)
+            
+        # <styleUrl>
+        if self.style:
+            styleUrl = doc.createElement('styleUrl')
+            pm.appendChild(styleUrl)
+            url = doc.createTextNode("#" + self.style)
+            styleUrl.appendChild(url)
+            
+        # <description>
+        if self.description != "":
+            desc = doc.createElement('description')
+            pm.appendChild(desc)
+            descText = doc.createTextNode(self.description)
+            desc.appendChild(descText)
+            
+        # <ExtendedData>
+        if self.data:
+            _appendExtendedData(doc, pm, self.data, self.schema)
+            
+        # <gx:Track>
+        track = doc.createElement('gx:Track')
+        # Declared here rather than on <kml>, so documents without tracks are written as before
+        track.setAttribute('xmlns:gx', GX_NAMESPACE)
+        pm.appendChild(track)
+        # <extrude>
+        if self.extrude:
+            extr = doc.createElement('extrude')
+            track.appendChild(extr)
+            extrText = doc.createTextNode(str(self.extrude))
+            extr.appendChild(extrText)
+        # <altitudeMode>
+        altmode = doc.createElement('altitudeMode')
+        track.appendChild(altmode)
+        altmodeText = doc.createTextNode(self.altMode)
+        altmode.appendChild(altmodeText)
+        # <when> and <gx:coord>
+        if precision is None:
+            track.appendChild(Fragment(self.render))
         else:
-            for lat, lon, alt in zip(self.lats, self.lons, self.alts):
-                coordsText = doc.createTextNode('%s, %s, %s' %(lon, lat, alt))
-                coords.appendChild(coordsText)             
+            track.appendChild(Fragment(lambda writer, indent, addindent, newl: self.render(writer, indent, addindent, newl, precision)))
         
         return doc
     
+    def render(self, writer, indent, addindent, newl, precision=None):
+        """ Write <when> and <gx:coord> lists to the writer object, with the given number of decimals of coordinates """
+        whens = [_escape(when) for when in _toList(self.whens)]
+        lats = _coordinateList(self.lats)
+        lons = _coordinateList(self.lons)
+        n = len(whens)
+        if len(lats) != n or len(lons) != n or (self.alts is not None and len(self.alts) != n):
+            raise ValueError("Track arrays must have the same length")
+        if n == 0:
+            return
+        whenTemplate = indent + "<when>%s</when>" + newl
+        if precision is not None:
+            # Coordinates are formatted at once, with values separated by spaces instead of commas
+            coords = formatCoordinates(lats, lons, self.alts, precision).replace(",", " ").split("\n")
+            writer.write((whenTemplate * n) % tuple(whens))
+            writer.write(((indent + "<gx:coord>%s</gx:coord>" + newl) * n) % tuple(coords))
+            return
+        if self.alts is None:
+            template = indent + "<gx:coord>%s %s 0</gx:coord>" + newl
+            values = [None] * (2 * n)
+            values[0::2] = lons
+            values[1::2] = lats
+        else:
+            template = indent + "<gx:coord>%s %s %s</gx:coord>" + newl
+            values = [None] * (3 * n)
+            values[0::3] = lons
+            values[1::3] = lats
+            values[2::3] = _coordinateList(self.alts)
+        writer.write((whenTemplate * n) % tuple(whens))
+        writer.write((template * n) % tuple(values))
+
+
+def pointsToTrack(points, name="", description="", style=None, **kwargs):
+    """ Convert a sequence of Point objects to a single Track.
+    
+    Arguments:
+    points - Point objects in time order, each with a TimeStamp or TimeSpan start date
+    name - track name
+    description - track description
+    style - a style to be used by the track, style of the first point is used if not given
+    
+    Other keyword arguments are passed to Track. Raises ValueError if a point has no date.
+    
+    """
+    points = list(points)
+    whens = []
+    for point in points:
+        when = point.dt or point.sdt
+        if not when:
+            raise ValueError("Point %s has no date" % point.name)
+        whens.append(when)
+    if style is None and points:
+        style = points[0].style
+    return Track(whens, [point.lat for point in points], [point.lon for point in points], name=name,
+                 description=description, style=style, **kwargs)
+    
     
-class GroundOverlay:
+class GroundOverlay(object):
     """GroundOverlay class.
     
     Represents Google Earth GroundOverlay, an image that is displayed on the ground.
     
     """
+    __slots__ = ('name', 'desc', 'icon', 'north', 'south', 'east', 'west', 'rotation', 'precision')
     
-    def __init__(self, name, description, icon, north, south, east, west, rotation=0):
+    def __init__(self, name, description, icon, north, south, east, west, rotation=0, precision=None):
         """ Init GroundOverlay.
         
         Arguments:
@@ -654,6 +4392,7 @@ class GroundOverlay:
         east - longitude of eastmost point of the image
         west - longitude of westmost point of the image
         rotation - rotation of y-axis of the image in degrees, clockwise
+        precision - number of decimals of the numbers, see formatNumber
         
         """
         self.name = name
@@ -664,10 +4403,17 @@ class GroundOverlay:
         self.east = east
         self.west = west
         self.rotation = rotation
+        self.precision = precision
         
-    def kml(self):
-        """ Create GoundOverlay node. Return xml.dom.minidom.Document """
-        doc = xdm.Document()
+    def kml(self, precision=None):
+        """ Create GoundOverlay node. Return xml.dom.minidom.Document
+        
+        Arguments:
+        precision - number of decimals of the numbers, used if the overlay has no precision of its own
+        
+        """
+        precision = self.precision if self.precision is not None else precision
+        doc = Document()
         
         # <GroundOverlay>
         overlay = doc.createElement('GroundOverlay')
@@ -702,27 +4448,27 @@ class GroundOverlay:
         # <north>
         north = doc.createElement('north')
         latlonbox.appendChild(north)
-        northText = doc.createTextNode(str(self.north))
+        northText = doc.createTextNode(formatNumber(self.north, precision))
         north.appendChild(northText)
         # <south>
         south = doc.createElement('south')
         latlonbox.appendChild(south)
-        southText = doc.createTextNode(str(self.south))
+        southText = doc.createTextNode(formatNumber(self.south, precision))
         south.appendChild(southText)        
         # <east>
         east = doc.createElement('east')
         latlonbox.appendChild(east)
-        eastText = doc.createTextNode(str(self.east))
+        eastText = doc.createTextNode(formatNumber(self.east, precision))
         east.appendChild(eastText)        
         # <west>
         west = doc.createElement('west')
         latlonbox.appendChild(west)
-        westText = doc.createTextNode(str(self.west))
+        westText = doc.createTextNode(formatNumber(self.west, precision))
         west.appendChild(westText)
         # <rotation>
         rotation = doc.createElement('rotation')
         latlonbox.appendChild(rotation)
-        rotationText = doc.createTextNode(str(self.rotation))
+        rotationText = doc.createTextNode(formatNumber(self.rotation, precision))
         rotation.appendChild(rotationText)
         
         return doc
@@ -734,7 +4480,8 @@ class Polygon(Placemark):
     Represents Google Earth Polygon - a 2 or 3-dimensional shape, on or above the ground.
      
     """
-    def __init__(self, name, description, coordinates, style=None, extrude=1, altitudeMode="relativeToGround"):
+    __slots__ = ('coordinates', 'extrude', 'altitudeMode', 'style', 'lats', 'lons', 'alts', 'simplify', 'simplifyMethod', 'vertexCounts', 'precision')
+    def __init__(self, name, description, coordinates=None, style=None, extrude=1, altitudeMode="relativeToGround", latsArray=None, lonsArray=None, altsArray=None, simplify=None, simplifyMethod="douglas-peucker", data=None, schema=None, precision=None):
         """ Init Polygon
         
         Arguments:
@@ -743,17 +4490,39 @@ class Polygon(Placemark):
         coordinates - new line separated list of geographical coordinates in format of: longitude, latitude, altitude\n
         style - kml style to use for the polygon
         extrude - whether the polygon should be extruded down to the ground
+        latsArray - an array of latitudes of the outer boundary, used instead of coordinates
+        lonsArray - an array of longitudes of the outer boundary
+        altsArray - an array of altitudes of the outer boundary
+        simplify - a tolerance in metres, the boundary is simplified when KML is created if given, see simplify()
+        simplifyMethod - douglas-peucker or visvalingam
+        data - a dictionary of field values written as ExtendedData
+        schema - id of a Schema typing the data fields
+        precision - number of decimals of coordinates, see formatCoordinates. Coordinates given as a string are
+                    parsed and written again.
         
         """        
-        Placemark.__init__(self, name, description)
+        Placemark.__init__(self, name, description, data, schema)
         self.coordinates = coordinates
+        self.lats = latsArray
+        self.lons = lonsArray
+        self.alts = altsArray
         self.extrude = extrude
         self.altitudeMode = altitudeMode
         self.style = style
+        self.simplify = simplify
+        self.simplifyMethod = simplifyMethod
+        self.vertexCounts = None
+        self.precision = precision
         
-    def kml(self):
-        """ Create Polygon node. Return xml.dom.minidom.Document """
-        doc = xdm.Document()
+    def kml(self, precision=None):
+        """ Create Polygon node. Return xml.dom.minidom.Document
+        
+        Arguments:
+        precision - number of decimals of coordinates, used if the polygon has no precision of its own
+        
+        """
+        precision = self.precision if self.precision is not None else precision
+        doc = Document()
         
         # <Placemark>
         pm = doc.createElement('Placemark')
@@ -779,6 +4548,10 @@ class Polygon(Placemark):
             pm.appendChild(desc)
             descText = doc.createTextNode(self.description)
             desc.appendChild(descText)
+            
+        # <ExtendedData>
+        if self.data:
+            _appendExtendedData(doc, pm, self.data, self.schema)
         
         # <Polygon>
         poly = doc.createElement('Polygon')
@@ -803,10 +4576,229 @@ class Polygon(Placemark):
         # <coordinates>
         coords = doc.createElement('coordinates')
         lr.appendChild(coords)
-        for c in self.coordinates.split("\n"):
-            coordsText = doc.createTextNode(c)
-            coords.appendChild(coordsText)
+        if self.simplify is not None or (precision is not None and self.coordinates is not None):
+            if self.coordinates is None:
+                lats, lons, alts = self.lats, self.lons, self.alts
+            else:
+                lats, lons, alts = _parseCoordinates(self.coordinates)
+            if self.simplify is not None:
+                lats, lons, alts, self.vertexCounts = _simplifyArrays(lats, lons, alts, self.simplify, self.simplifyMethod, ring=True)
+            coordsText = doc.createTextNode(formatCoordinates(lats, lons, alts, precision))
+        elif self.coordinates is None:
+            coordsText = doc.createTextNode(formatCoordinates(self.lats, self.lons, self.alts, precision))
+        else:
+            coordsText = doc.createTextNode(self.coordinates.strip())
+        coords.appendChild(coordsText)
         
         return doc
  
-    
\ No newline at end of file
+    
+
+
+class Region:
+    """ Region class.
+    
+    Represents a Google Earth Region, a bounding box with level of detail limits. Features with a Region are only
+    shown (and NetworkLinks only loaded) when the box takes between minLodPixels and maxLodPixels on the screen.
+    
+    """
+    
+    def __init__(self, north, south, east, west, minLodPixels=128, maxLodPixels=-1):
+        """ Init Region.
+        
+        Arguments:
+        north - latitude of the north edge of the region
+        south - latitude of the south edge of the region
+        east - longitude of the east edge of the region
+        west - longitude of the west edge of the region
+        minLodPixels - minimum size of the region on the screen in pixels
+        maxLodPixels - maximum size of the region on the screen in pixels, -1 for no limit
+        
+        """
+        self.north = north
+        self.south = south
+        self.east = east
+        self.west = west
+        self.minLod = minLodPixels
+        self.maxLod = maxLodPixels
+        
+    def kml(self):
+        """ Create Region node. Return xml.dom.minidom.Document """
+        doc = Document()
+        
+        # <Region>
+        region = doc.createElement('Region')
+        doc.appendChild(region)
+        
+        # <LatLonAltBox>
+        box = doc.createElement('LatLonAltBox')
+        region.appendChild(box)
+        for tag, value in (('north', self.north), ('south', self.south), ('east', self.east), ('west', self.west)):
+            node = doc.createElement(tag)
+            box.appendChild(node)
+            node.appendChild(doc.createTextNode(str(value)))
+            
+        # <Lod>
+        lod = doc.createElement('Lod')
+        region.appendChild(lod)
+        for tag, value in (('minLodPixels', self.minLod), ('maxLodPixels', self.maxLod)):
+            node = doc.createElement(tag)
+            lod.appendChild(node)
+            node.appendChild(doc.createTextNode(str(value)))
+            
+        return doc
+    
+    
+class LookAt:
+    """ LookAt class.
+    
+    Represents a Google Earth LookAt, a view of a point on the ground from a given distance. Set on the document,
+    it's the view Google Earth flies to when the file is opened.
+    
+    """
+    
+    def __init__(self, latitude, longitude, range, tilt=0, heading=0):
+        """ Init LookAt.
+        
+        Arguments:
+        latitude - latitude of the point looked at
+        longitude - longitude of the point looked at
+        range - distance from the point in metres
+        tilt - angle between the view and the vertical in degrees
+        heading - direction of the view in degrees, 0 is north
+        
+        """
+        self.lat = latitude
+        self.lon = longitude
+        self.range = range
+        self.tilt = tilt
+        self.heading = heading
+        
+    def kml(self):
+        """ Create LookAt node. Return xml.dom.minidom.Document """
+        doc = Document()
+        
+        # <LookAt>
+        lookAt = doc.createElement('LookAt')
+        doc.appendChild(lookAt)
+        for tag, value in (('longitude', self.lon), ('latitude', self.lat), ('altitude', 0), ('heading', self.heading),
+                           ('tilt', self.tilt), ('range', self.range)):
+            node = doc.createElement(tag)
+            lookAt.appendChild(node)
+            node.appendChild(doc.createTextNode(str(value)))
+            
+        return doc
+    
+    
+def lookAtBounds(south, west, north, east, minRange=1000.0):
+    """ Return a LookAt showing a whole box from straight above.
+    
+    Arguments:
+    south, west, north, east - edges of the box
+    minRange - minimum distance in metres, used for boxes of a single point
+    
+    """
+    latitude = (south + north) / 2.0
+    size = math.radians(max(north - south, (east - west) * math.cos(math.radians(latitude)))) * _earthRadius
+    # Google Earth shows about 1.15 times the range across the view, a margin is added
+    return LookAt(latitude, (west + east) / 2.0, round(max(size * 1.2, minRange), 1))
+    
+    
+class NetworkLink:
+    """ NetworkLink class.
+    
+    Represents a Google Earth NetworkLink, which loads another KML file. With a Region the file is loaded only when
+    the region becomes visible.
+    
+    """
+    
+    def __init__(self, href, name="", region=None, startDate="", endDate=""):
+        """ Init NetworkLink.
+        
+        Arguments:
+        href - an url or a relative path of the linked file
+        name - NetworkLink name
+        region - a Region object limiting when the link is loaded
+        startDate - a start date for TimeSpan element
+        endDate - an end date for TimeSpan element
+        
+        """
+        self.href = href
+        self.name = name
+        self.region = region
+        self.sdt = startDate
+        self.edt = endDate
+        
+    def kml(self):
+        """ Create NetworkLink node. Return xml.dom.minidom.Document """
+        doc = Document()
+        
+        # <NetworkLink>
+        link = doc.createElement('NetworkLink')
+        doc.appendChild(link)
+        
+        # <name>
+        if self.name != '':
+            nameNode = doc.createElement('name')
+            link.appendChild(nameNode)
+            nameNode.appendChild(doc.createTextNode(self.name))
+            
+        # <TimeSpan>
+        if self.sdt != '':
+            timespan = doc.createElement('TimeSpan')
+            link.appendChild(timespan)
+            # <begin>
+            begin = doc.createElement('begin')
+            timespan.appendChild(begin)
+            begin.appendChild(doc.createTextNode(self.sdt))
+            # <end>
+            if self.edt != '':
+                end = doc.createElement('end')
+                timespan.appendChild(end)
+                end.appendChild(doc.createTextNode(self.edt))
+            
+        # <Region>
+        if self.region is not None:
+            link.appendChild(self.region.kml().documentElement)
+            
+        # <Link>
+        linkNode = doc.createElement('Link')
+        link.appendChild(linkNode)
+        # <href>
+        href = doc.createElement('href')
+        linkNode.appendChild(href)
+        href.appendChild(doc.createTextNode(self.href))
+        # <viewRefreshMode>
+        if self.region is not None:
+            refresh = doc.createElement('viewRefreshMode')
+            linkNode.appendChild(refresh)
+            refresh.appendChild(doc.createTextNode('onRegion'))
+        
+        return doc
+
+
+def main(argv=None):
+    """ Command line interface, see python kml_writer.py --help """
+    import argparse
+    parser = argparse.ArgumentParser(description="Tools for KML files written by kml_writer")
+    commands = parser.add_subparsers(dest='command')
+    merge = commands.add_parser('merge', help="merge many KML files into one, see mergeKML")
+    merge.add_argument('sources', nargs='+', help="input kml files")
+    merge.add_argument('-o', '--output', required=True, help="output kml file")
+    merge.add_argument('--title', default="", help="title of the merged document")
+    merge.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'), help="keep placemarks intersecting the box")
+    merge.add_argument('--start', help="keep placemarks ending after this date")
+    merge.add_argument('--end', help="keep placemarks starting before this date")
+    merge.add_argument('--keep-folders', action='store_true', help="don't merge folders with the same name")
+    merge.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help="number of worker processes reading the files")
+    merge.add_argument('--compact', action='store_true', help="write without indentation and newlines")
+    args = parser.parse_args(argv)
+    
+    if args.command == 'merge':
+        count = mergeKML(args.sources, args.output, args.title, bbox=args.bbox, start=args.start, end=args.end,
+                         mergeFolders=not args.keep_folders, processes=args.processes, compact=args.compact)
+        print "%d placemarks written to %s" % (count, args.output)
+
+
+if __name__ == '__main__':
+    main()